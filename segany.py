@@ -43,6 +43,7 @@ from gi.repository import Gdk
 import tempfile
 import subprocess
 import threading
+import queue
 from os.path import exists
 from array import array
 import random
@@ -51,10 +52,17 @@ import struct
 import json
 import logging
 import functools
-import chardet
 import traceback
-import cv2
-from seganybridge import SegmentAnythingProcessor
+import numpy as np
+# seganybridge (torch, cv2, segment_anything) is only imported once a segmentation
+# runs in-process: GIMP loads this file at every startup to query the procedures
+from seganyparams import AUTO_PARAM_TYPES, MASK_FILTER_TYPES
+from seganyformat import read_mask, unpack_array
+from seganyprofile import profiler, PROFILE_MODES
+from seganyserver import (SegmentAnythingClient, SegmentAnythingServerError, DEFAULT_IDLE_TIMEOUT,
+                          DEFAULT_MODEL_BUDGET)
+from seganytask import SegmentationTask, SegmentationCancelled, describe_progress
+from seganypipeline import Pipeline, DEFAULT_QUEUE_DEPTH
 
 # Not used currently (plugin pnly works with python2)
 def getVersion():
@@ -105,84 +113,142 @@ def run_subprocess(cmd):
     stdout, stderr = child.communicate()
     print(stdout)
 
-# Read a binary file containing a packed boolean array (a 2D array of True/False values) and
-# convert it into a standard Python list of lists where each inner list represents a row of the boolean arra
+# Read a .seg file containing a packed boolean array (a 2D array of True/False values) and
+# return it as a NumPy bool array. Reads both the versioned and the legacy rows/cols header.
 def unpackBoolArray(filepath):
     with open(filepath, 'rb') as file:
         packed_data = file.read()
+    return unpack_array(packed_data)
 
-    num_rows, num_cols = struct.unpack(">II", packed_data[:8])
-     
-    unpacked_data = []
-    byte_index = 8       # Skip the first 8 bytes for num_rows and num_cols
-    bit_position = 0
-    
-    for _ in range(num_rows):
-        unpacked_row = []
-        for _ in range(num_cols):
-            current_byte = packed_data[byte_index]
-            boolean_value = (current_byte >> bit_position) & 1
-            unpacked_row.append(boolean_value)
-
-            bit_position += 1
-            if bit_position == 8:
-                bit_position = 0
-                byte_index += 1 # Increment only when needed
-
-        unpacked_data.append(unpacked_row)
-
-    return unpacked_data
-
-def readMaskFile(filepath, formatBinary):
+def readMaskFile(filepath, formatBinary, withOrigin=False):
     print("readMaskFile: ",filepath)
-    if formatBinary:
-        return unpackBoolArray(filepath)
-    else:  # Only for testing
-        mask = []
-        try: # Add try/except block for robustness
-            with open(filepath, 'r') as f:
-                for line in f: # Iterate through lines directly
-                    mask.append([val == '1' for val in line.strip().split()]) # Split and strip the line
-        except FileNotFoundError:
-            logging.error(f"Mask file not found: {filepath}")
-            return None # Return None to indicate failure
-        except Exception as e:
-            logging.error(f"Error reading mask file: {str(e)}")
-            return None
-        return mask
+    try: # Add try/except block for robustness
+        return read_mask(filepath, formatBinary, withOrigin)
+    except FileNotFoundError:
+        logging.error(f"Mask file not found: {filepath}")
+        return None # Return None to indicate failure
+    except Exception as e:
+        logging.error(f"Error reading mask file: {str(e)}")
+        return None
 
-def exportSelection(image, expfile, exportCnt):
+# Selection values above this count as selected (0-255 scale, as Gimp.Selection.value)
+SELECTION_THRESHOLD = 200
+selPtStrategyVals = ['Random', 'Distance', 'K-Means']
+largeImageModeVals = ['Off', 'Downscale', 'Tiled']
+autoPresetVals = ['Draft', 'Balanced', 'Full']
+cpuModeVals = ['Off', 'Int8', 'BF16']
+backendVals = {'PyTorch': 'torch', 'ONNX Decoder': 'onnx', 'ONNX Full': 'onnx-full'}
+outputModeVals = ['Layers', 'Label Map']
+labelOrderVals = ['Area', 'Score']
+
+# Options for SegmentAnythingProcessor's large image mode from the dialog values
+def getLargeImageOptions(values):
+    return {
+        'mode': values.largeImageMode.lower(),
+        'min_pixels': int(values.largeImageMinMP * 1_000_000),
+        'memory_budget': int(values.largeImageBudgetMB * 1024 * 1024),
+        'refine_edges': values.largeImageRefineEdges,
+    }
+
+# CPU inference options for SegmentAnythingProcessor (only used when there is no GPU)
+def getCpuOptions(values):
+    return {
+        'quantize': values.cpuMode == 'Int8',
+        'bf16': values.cpuMode == 'BF16',
+        'threads': int(values.cpuThreads),
+        'interop_threads': int(values.cpuInteropThreads),
+    }
+
+# Keyword options for SegmentAnythingProcessor (also sent to the model server)
+def getProcessorOptions(values):
+    return {
+        'cpu_options': getCpuOptions(values),
+        'backend': backendVals.get(values.backend, 'torch'),
+        'onnx_dir': values.onnxDir,
+        'mmap_weights': values.mmapWeights,
+    }
+
+# Auto mode result cache arguments, sent with each request so they are not
+# part of the server's model pool key
+def getResultCacheOptions(values):
+    return {
+        'result_cache_dir': values.resultCacheDir if values.cacheAutoResults else None,
+        'result_cache_bytes': int(values.resultCacheMb * 1024 ** 2),
+    }
+
+# Fetch the selection mask inside its bounds as one bool array.
+# Returns (mask, x1, y1) or None when nothing is selected.
+def getSelectionMask(image):
     selection_bounds_tuple = Gimp.Selection.bounds(image)
-
-    if not selection_bounds_tuple.non_empty:  # Check if selection is empty
+    if not selection_bounds_tuple.non_empty:
+        return None
+    x1, y1, x2, y2 = selection_bounds_tuple.x1, selection_bounds_tuple.y1, selection_bounds_tuple.x2, selection_bounds_tuple.y2
+    buffer = image.get_selection().get_buffer()
+    rect = Gegl.Rectangle.new(x1, y1, x2 - x1, y2 - y1)
+    data = buffer.get(rect, 1.0, "Y u8", Gegl.AbyssPolicy.NONE)
+    values = np.frombuffer(data, dtype=np.uint8).reshape(y2 - y1, x2 - x1)
+    return values > SELECTION_THRESHOLD, x1, y1
+
+# Pick up to count points inside mask, returned as an Nx2 array of (x, y).
+#   Random:   uniform sample of selected pixels
+#   Distance: peaks of the distance transform, i.e. points far from the selection edge
+#   K-Means:  k-means centroids of the selected pixels, snapped to the nearest selected pixel
+def sampleSelectionPoints(mask, count, strategy='Random'):
+    import cv2
+    ys, xs = np.nonzero(mask)
+    if count <= 0 or xs.size == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    count = min(count, xs.size)
+    coords = np.stack([xs, ys], axis=1)
+
+    if strategy == 'Distance':
+        dist = cv2.distanceTransform(np.pad(mask, 1).astype(np.uint8), cv2.DIST_L2, 5)[1:-1, 1:-1]
+        # Local maxima over a window sized so count points would roughly tile the
+        # selection, which keeps the points from clumping on one ridge
+        size = 2 * int(np.sqrt(xs.size / (np.pi * count)) / 2) + 1
+        peaks = mask & (dist >= cv2.dilate(dist, np.ones((size, size), np.uint8)))
+        py, px = np.nonzero(peaks)
+        order = np.argsort(dist[py, px])[::-1][:count]
+        picked = np.stack([px[order], py[order]], axis=1)
+        if len(picked) < count:
+            rest = coords[~peaks[ys, xs]]
+            rest = rest[np.random.choice(rest.shape[0], count - len(picked), replace=False)]
+            picked = np.concatenate([picked, rest])
+        return picked
+
+    if strategy == 'K-Means':
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
+        samples = coords if coords.shape[0] <= 200000 else \
+            coords[np.random.choice(coords.shape[0], 200000, replace=False)]
+        _, _, centers = cv2.kmeans(samples.astype(np.float32), count, None, criteria, 1,
+                                   cv2.KMEANS_PP_CENTERS)
+        # Centroids of non-convex regions can fall outside the selection
+        nearest = np.unique([np.argmin(((coords - center) ** 2).sum(axis=1)) for center in centers])
+        picked = coords[nearest]
+        if len(picked) < count:
+            # Centroids that snapped to the same pixel are topped up with random selected pixels
+            rest = np.delete(coords, nearest, axis=0)
+            rest = rest[np.random.choice(rest.shape[0], count - len(picked), replace=False)]
+            picked = np.concatenate([picked, rest])
+        return picked
+
+    return coords[np.random.choice(coords.shape[0], count, replace=False)]
+
+# Exactly selPtCnt (or all, if fewer) selection points in image coordinates
+def getSelectionPoints(image, exportCnt, strategy='Random'):
+    selection = getSelectionMask(image)
+    if selection is None:
         logging.warning("No selection found. Exporting no points.")
-        try:  # Try/except block for file operations even if no selection
-            with open(expfile, 'w') as f:
-                return True  # Successfully created (empty) file
-        except Exception as e:
-            logging.error(f"Error creating export file: {str(e)}")
-            return None
+        return np.zeros((0, 2), dtype=np.int64)
+    mask, x1, y1 = selection
+    return sampleSelectionPoints(mask, exportCnt, strategy) + [x1, y1]
 
+def exportSelection(image, expfile, exportCnt, strategy='Random'):
     try:  # Try/except block encompassing both calculation and writing
-        x1, y1, x2, y2 = selection_bounds_tuple.x1, selection_bounds_tuple.y1, selection_bounds_tuple.x2, selection_bounds_tuple.y2
-        coords = []
-        numPts = (x2 - x1) * (y2 - y1)
-        if exportCnt >= numPts:
-            selIdxs = range(numPts)
-        else:
-            selIdxs = random.sample(range(numPts), exportCnt)
-
-        for selIdx in selIdxs:
-            x = x1 + selIdx % (x2 - x1)
-            y = y1 + int(selIdx / (x2 - x1))
-            value = Gimp.Selection.value(image, x, y)
-            if value > 200:
-                coords.append((x, y))
-
+        coords = getSelectionPoints(image, exportCnt, strategy)
         with open(expfile, 'w') as f:
             for co in coords:
                 f.write(f"{co[0]} {co[1]}\n")
-
         return True  # Indicate successful export
 
     except Exception as e:
@@ -198,82 +264,263 @@ def getRandomColor(layerCnt):
 
     return list(uniqueColors)
 
-# Change for Gimp 3.0 native.  Create corresponding layers in the GIMP image, visualizing the segmented regions.
-def createLayers(image, maskFileNoExt, userSelColor, formatBinary):
+# Largest chunk of pixels built in memory for one Gegl buffer write
+MAX_BAND_BYTES = 64 * 1024 * 1024
+
+# Convert a Gdk.RGBA or a list of 0-255 components to a list of ints
+def getColorList(color):
+    if isinstance(color, Gdk.RGBA):
+        return [int(color.red * 255), int(color.green * 255), int(color.blue * 255), int(color.alpha * 255)]
+    return [int(c) for c in color]
+
+# Build the pixels of a mask as NumPy arrays, yielded as (top row, rows, bytes) bands of at
+# most MAX_BAND_BYTES. Pure NumPy, so it can run off the main thread.
+def renderMaskBands(mask, color):
+    mask = np.asarray(mask, dtype=bool)
+    height, width = mask.shape
+    color = np.asarray(color, dtype=np.uint8)
+    pix_size = color.size
+    band_rows = max(1, MAX_BAND_BYTES // max(1, width * pix_size))
+    for top in range(0, height, band_rows):
+        band = mask[top:top + band_rows]
+        pixels = np.zeros(band.shape + (pix_size,), dtype=np.uint8)
+        pixels[band] = color
+        yield top, band.shape[0], pixels.tobytes()
+
+# Write rendered bands to the Gegl buffer, one rectangle set() each
+def writeBands(buffer, bands, width, bablFormat, x0=0, y0=0):
+    for top, rows, data in bands:
+        rect = Gegl.Rectangle.new(x0, y0 + top, width, rows)
+        buffer.set(rect, bablFormat, data)
+    buffer.flush()
+
+# Write a mask to the Gegl buffer in a few row bands instead of one set_pixel() call per pixel
+def writeMaskToBuffer(buffer, mask, color, bablFormat, x0=0, y0=0):
+    mask = np.asarray(mask, dtype=bool)
+    writeBands(buffer, renderMaskBands(mask, color), mask.shape[1], bablFormat, x0, y0)
+
+# Layer type, Babl format and mask colour (None for random colours) of mask layers in image
+def getLayerFormat(image, userSelColor):
+    if image.get_base_type() == Gimp.ImageBaseType.GRAY:  # Use Gimp enum
+        return Gimp.ImageType.GRAYA_IMAGE, "Y'A u8", [100, 255]
+    return Gimp.ImageType.RGBA_IMAGE, "R'G'B'A u8", userSelColor
+
+# Colour of the idx-th mask layer
+def getMaskColor(userSelColor, uniqueColors, idx):
+    return userSelColor if userSelColor is not None else list(uniqueColors[idx % len(uniqueColors)]) + [255]
+
+# Pipeline stage (see seganypipeline) that renders mask records into layer pixels off the main
+# thread. Each record comes out with its 'bbox' and 'bands' (renderMaskBands, None for an empty
+# mask) instead of its 'segmentation'; colours are picked in the same order as createLayers.
+class MaskRenderer:
+    def __init__(self, userSelColor):
+        self.userSelColor = userSelColor
+        self.uniqueColors = getRandomColor(layerCnt=999)
+        self.idx = 0
+
+    def __call__(self, mask):
+        maskVals, bbox = getMaskCrop(mask)
+        record = dict(mask) if isinstance(mask, dict) else {}
+        record['segmentation'] = None
+        record['bbox'] = bbox
+        record['bands'] = None
+        if bbox[2] > 0 and bbox[3] > 0:
+            color = getMaskColor(self.userSelColor, self.uniqueColors, self.idx)
+            record['bands'] = list(renderMaskBands(maskVals, color))
+            self.idx += 1
+        return record
+
+# Flattened RGB pixels of the image as an HxWx3 uint8 array, read from the GIMP
+# projection through a Gegl buffer so unsaved edits are included and nothing is
+# decoded from disk.
+def getImagePixels(image):
+    width = image.get_width()
+    height = image.get_height()
+    visible = Gimp.Layer.new_from_visible(image, image, "segany-source")
     try:
-        logging.info("In createLayers (try)")
-        # ... rest of your code ...
+        buffer = visible.get_buffer()
+        rect = Gegl.Rectangle.new(0, 0, width, height)
+        data = buffer.get(rect, 1.0, "R'G'B' u8", Gegl.AbyssPolicy.CLAMP)
+    finally:
+        visible.delete()
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+
+# Masks exported as <maskFileNoExt><idx>.seg files, in the record format returned by
+# SegmentAnythingProcessor.segment() (score and bbox are not stored in the files)
+def readMaskFiles(maskFileNoExt, formatBinary, maxLayers=99999):
+    for idx in range(maxLayers):
+        filepath = maskFileNoExt + str(idx) + '.seg'
+        logging.debug(f"Layer source filepath: {filepath}")
+        if not exists(filepath):
+            break
+        maskData = readMaskFile(filepath, formatBinary, withOrigin=True)
+        if maskData is None:
+            break
+        maskVals, origin = maskData
+        # Cropped masks carry their origin; full canvas masks get their bbox in createLayers
+        bbox = None if origin is None else (origin[0], origin[1], maskVals.shape[1], maskVals.shape[0])
+        yield {'segmentation': maskVals, 'score': None, 'bbox': bbox}
+
+# XYWH bounds of the True pixels of a full canvas mask, (0, 0, 0, 0) when it is empty
+def getMaskBounds(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return (0, 0, 0, 0)
+    cols = np.flatnonzero(mask.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+
+# The mask of a record cropped to its bbox, with the bbox. Records from run_segmentation with
+# crop_masks are already cropped (their mask's shape is the bbox size).
+def getMaskCrop(mask):
+    maskVals = mask['segmentation'] if isinstance(mask, dict) else mask
+    bbox = mask.get('bbox') if isinstance(mask, dict) else None
+    if bbox is None:
+        bbox = getMaskBounds(maskVals)
+    x, y, w, h = bbox
+    if maskVals.shape != (h, w):
+        maskVals = maskVals[y:y + h, x:x + w]
+    return maskVals, bbox
 
+# Change for Gimp 3.0 native.  Create corresponding layers in the GIMP image, visualizing the segmented regions.
+# masks is an iterable of mask records ({'segmentation': bool array, ...}) or plain arrays. Each layer
+# only covers its mask's bounding box and is placed with offsets; empty masks get no layer.
+# progress is an optional SegmentationProgress; cancelling it removes the layers created so far.
+# Records already rendered by MaskRenderer (e.g. coming out of a Pipeline) are written as they
+# are. An error raised by masks itself also removes the layers and is passed on.
+def createLayers(image, masks, userSelColor, maxLayers=99999, progress=None):
+    parents = {}
+    sourceFailed = False
+    try:
         width = image.get_width()
         height = image.get_height()
-        logging.info(f"In createLayers:  {maskFileNoExt}")
+        logging.info("In createLayers")
         idx = 0
-        maxLayers = 99999
 
-        parent = Gimp.LayerGroup.new(image)  # Correct way to create layer group
-        image.insert_layer(parent, None, 0)  # Use image.insert_layer
-        parent.set_opacity(50)
+        # Masks carrying a 'group' (e.g. one per box in Multi-Box mode) get a layer group each
+        def getParent(group):
+            if group not in parents:
+                parent = Gimp.LayerGroup.new(image)  # Correct way to create layer group
+                image.insert_layer(parent, None, 0)  # Use image.insert_layer
+                parent.set_opacity(50)
+                if group is not None:
+                    parent.set_name(f"Box {group}")
+                parents[group] = parent
+            return parents[group]
 
         uniqueColors = getRandomColor(layerCnt=999)
 
-        if image.get_base_type() == Gimp.ImageType.GRAY:  # Use Gimp enum
-            layerType = Gimp.ImageType.GRAYA
-            userSelColor = [100, 255]
-        else:
-            layerType = Gimp.ImageType.RGBA
-            logging.info(f"createLayers: {width},{height} {maskFileNoExt}")
+        layerType, bablFormat, userSelColor = getLayerFormat(image, userSelColor)
+        logging.info(f"createLayers: {width},{height}")
+        total = min(len(masks), maxLayers) if hasattr(masks, '__len__') else None
 
+        masks = iter(masks)
         while idx < maxLayers:
-            filepath = maskFileNoExt + str(idx) + '.seg'
-            logging.debug(f"Layer source filepath: {filepath}")
-            if exists(filepath):
-                logging.info(f"Creating Layer: {(idx + 1)}")
-                newlayer = Gimp.Layer.new(image, f"Segment Auto {idx}",  # Correct way to create layer
-                                          layerType, 100,
-                                          Gimp.LayerMode.NORMAL)  # Use Gimp enum
-                image.insert_layer(newlayer, parent, 0)  # Use image.insert_layer and parent
-                newlayer.set_visible(False)  # Use set_visible
-                buffer = newlayer.get_buffer()
-
-                maskVals = readMaskFile(filepath, formatBinary)
-                maskColor = userSelColor if userSelColor is not None else list(uniqueColors[idx]) + [255]
-            
-            #     --- FIX: Populate a single bytearray instead of a list of strings
-                pixels = bytearray(width * height * pix_size)
-                for x, row in enumerate(maskVals):
-                    for y, p in enumerate(row):
-                        if p:
-                            pos = (y + width * x) * pix_size
-                            pixels[pos: pos + pix_size] = mask_color_bytes
-            
-                buffer.set(rect, babl_format, bytes(pixels))
-                # --- END FIX
-
-                x = 0
-                for line in maskVals:
-                    y = 0
-                    for p in line:
-                        if p:
-                            # Set pixel in buffer
-                            buffer.set_pixel(x, y, maskColor)
-                        else:
-                            buffer.set_pixel(x, y, [0, 0, 0, 0] if layerType == Gimp.ImageType.RGBA else [0, 0])
-                            y += 1
-                            x += 1
-
-                newlayer.flush()
-                newlayer.merge_shadow(True)
-                newlayer.update(0, 0, width, height)
-
-            else:
+            if progress is not None:
+                progress.update('layers', idx / total if total else None, masks=idx)
+            try:
+                mask = next(masks)
+            except StopIteration:
                 break
+            except Exception:
+                sourceFailed = True
+                raise
+            if isinstance(mask, dict) and 'bands' in mask:
+                bands, (x, y, w, h) = mask['bands'], mask['bbox']
+            else:
+                maskVals, (x, y, w, h) = getMaskCrop(mask)
+                bands = None
+                if w > 0 and h > 0:
+                    bands = renderMaskBands(maskVals, getMaskColor(userSelColor, uniqueColors, idx))
+            if bands is None:
+                logging.info("Skipping empty mask")
+                continue
+            parent = getParent(mask.get('group') if isinstance(mask, dict) else None)
+
+            logging.info(f"Creating Layer: {(idx + 1)} {w}x{h}+{x}+{y}")
+            newlayer = Gimp.Layer.new(image, f"Segment Auto {idx}", w, h,
+                                      layerType, 100, Gimp.LayerMode.NORMAL)
+            image.insert_layer(newlayer, parent, 0)  # Use image.insert_layer and parent
+            newlayer.set_offsets(x, y)
+            newlayer.set_visible(False)  # Use set_visible
+
+            writeBands(newlayer.get_buffer(), bands, w, bablFormat)
+            newlayer.update(0, 0, w, h)
+            idx += 1
 
         return idx
+    except SegmentationCancelled:
+        for parent in parents.values():
+            image.remove_layer(parent)
+        raise
     except Exception as e:
+        if sourceFailed:
+            for parent in parents.values():
+                image.remove_layer(parent)
+            raise
         logging.error(f"Error in createLayers: {e}")
         logging.error(traceback.format_exc())
         return 0
     
+# Render a label map record (run_segmentation with output='labels') as one layer: every label
+# gets a palette colour and the whole map is converted with one palette lookup per band. With
+# labelChannels each label is also added as a channel, written only inside its bounding box.
+# On any error the layer and channels created so far are removed before it propagates.
+def createLabelLayer(image, record, labelChannels=False, progress=None):
+    labels = record['segmentation']
+    info = record['labels']
+    height, width = labels.shape
+    if image.get_base_type() == Gimp.ImageBaseType.GRAY:
+        layerType, bablFormat = Gimp.ImageType.GRAYA_IMAGE, "Y'A u8"
+        palette = np.zeros((len(info) + 1, 2), dtype=np.uint8)
+        palette[1:, 0] = np.linspace(60, 255, len(info)) if info else []
+    else:
+        layerType, bablFormat = Gimp.ImageType.RGBA_IMAGE, "R'G'B'A u8"
+        palette = np.zeros((len(info) + 1, 4), dtype=np.uint8)
+        if info:
+            palette[1:, :3] = getRandomColor(len(info))
+    palette[1:, -1] = 255  # label 0 stays transparent
+
+    layer = Gimp.Layer.new(image, f"Segment Labels ({len(info)})", width, height,
+                           layerType, 100, Gimp.LayerMode.NORMAL)
+    image.insert_layer(layer, None, 0)
+    channels = []
+    try:
+        buffer = layer.get_buffer()
+        band_rows = max(1, MAX_BAND_BYTES // max(1, width * palette.shape[1]))
+        for top in range(0, height, band_rows):
+            if progress is not None:
+                progress.update('layers', top / height)
+            pixels = palette[labels[top:top + band_rows]]
+            buffer.set(Gegl.Rectangle.new(0, top, width, pixels.shape[0]), bablFormat, pixels.tobytes())
+        buffer.flush()
+        layer.update(0, 0, width, height)
+
+        if labelChannels:
+            for item in info:
+                if progress is not None:
+                    progress.update('channels', item['label'] / len(info), masks=item['label'])
+                x, y, w, h = item['bbox']
+                if w == 0 or h == 0:
+                    continue
+                color = Gegl.Color.new('black')
+                color.set_rgba(*(palette[item['label'], :3] / 255.0 if palette.shape[1] == 4 else (0, 0, 0)), 1.0)
+                channel = Gimp.Channel.new(image, f"Segment {item['label']}", width, height, 50, color)
+                image.insert_channel(channel, None, 0)
+                channels.append(channel)
+                channel.set_visible(False)
+                pixels = (labels[y:y + h, x:x + w] == item['label']).astype(np.uint8) * 255
+                channelBuffer = channel.get_buffer()
+                channelBuffer.set(Gegl.Rectangle.new(x, y, w, h), "Y u8", pixels.tobytes())
+                channelBuffer.flush()
+                channel.update(x, y, w, h)
+    except BaseException:
+        # Cancelled or failed: no half-built label layer is left in the image
+        for channel in channels:
+            image.remove_channel(channel)
+        image.remove_layer(layer)
+        raise
+    return len(info)
+
 def cleanup(filepathPrefix):
     for f in glob.glob(filepathPrefix + '*'):
         try:  # Add try/except for robust file removal
@@ -281,7 +528,137 @@ def cleanup(filepathPrefix):
         except OSError as e:
             logging.error(f"Error removing file {f}: {str(e)}")
 
-    
+
+
+# Progress of a segmentation running on a worker thread. GIMP and GTK calls stay on the main
+# thread: the worker's reports are queued and shown by pump(), which also keeps the small
+# Cancel dialog responsive. Cancel sets the task's flag (and cancels the request on the model
+# server); the processor stops at its next progress step with SegmentationCancelled.
+# Call func on a worker thread while pump() runs on this (GIMP's main) thread, so the
+# GTK main loop keeps handling events. Returns func's result or raises its error.
+def runOnWorker(pump, func, *args, **kwargs):
+    result = {}
+    def worker():
+        try:
+            result['value'] = func(*args, **kwargs)
+        except BaseException as e:
+            result['error'] = e
+    thread = threading.Thread(target=worker, name='segany-worker', daemon=True)
+    thread.start()
+    while thread.is_alive():
+        pump()
+        thread.join(0.05)
+    pump()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+# Handle the pending GTK events
+def pumpEvents():
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+class SegmentationProgress:
+    def __init__(self, title):
+        self.events = queue.Queue()
+        self.task = SegmentationTask(lambda stage, fraction, info: self.events.put((stage, fraction, info)))
+        Gimp.progress_init(title)
+        self.dialog = Gtk.Dialog(title, None, modal=False)
+        self.status = Gtk.Label(label='Starting')
+        self.status.set_width_chars(40)
+        self.dialog.vbox.pack_start(self.status, False, False, 5)
+        self.dialog.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        self.dialog.connect('response', lambda dialog, response: self.cancel())
+        self.dialog.show_all()
+
+    def cancel(self):
+        if not self.task.cancelled.is_set():
+            logging.info("Segmentation cancelled by the user")
+            self.status.set_text('Cancelling...')
+            self.task.cancel()
+
+    def show(self, stage, fraction, info):
+        text = describe_progress(stage, info)
+        if not self.task.cancelled.is_set():
+            self.status.set_text(text)
+        Gimp.progress_set_text(text)
+        if fraction is None:
+            Gimp.progress_pulse()
+        else:
+            Gimp.progress_update(fraction)
+
+    def pump(self):
+        while True:
+            try:
+                self.show(*self.events.get_nowait())
+            except queue.Empty:
+                break
+        pumpEvents()
+
+    def run(self, func, *args, **kwargs):
+        # Call func on a worker thread, returning its result (or raising its error)
+        return runOnWorker(self.pump, func, *args, **kwargs)
+
+    def update(self, stage, fraction=None, **info):
+        # Progress of work done on the main thread (layer creation)
+        self.show(stage, fraction, info)
+        self.pump()
+        self.task.check()
+
+    def close(self):
+        if self.dialog is not None:
+            self.dialog.destroy()
+            self.dialog = None
+            Gimp.progress_end()
+
+
+# Control points of each stroke of a path, as flat [x0, y0, x1, y1, ...] lists
+def getStrokePoints(path):
+    return [path.stroke_get_points(strokeId)[1] for strokeId in path.get_strokes()]
+
+# [x1, y1, x2, y2] of a stroke drawn as a rectangle (4 anchors, each stored as
+# handle/anchor/handle triplets), or None if the stroke is not a box
+def strokeToBox(points):
+    if len(points) != 24:
+        return None
+    xs, ys = points[2::6], points[3::6]
+    if len(set(xs)) != 2 or len(set(ys)) != 2:
+        return None
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+# Paths whose anchors are the include / exclude clicks of an Interactive session
+REFINE_POSITIVE_PATH = 'SAM+'
+REFINE_NEGATIVE_PATH = 'SAM-'
+
+# Anchor points of the SAM+ and SAM- paths as (points Nx2, labels N) with 1 = include
+def getRefinePoints(image):
+    points, labels = [], []
+    pathDict = getPathDict(image)
+    for pathName, label in ((REFINE_POSITIVE_PATH, 1), (REFINE_NEGATIVE_PATH, 0)):
+        path = pathDict.get(pathName)
+        if path is None:
+            continue
+        for strokePoints in getStrokePoints(path):
+            anchors = list(zip(strokePoints[2::6], strokePoints[3::6]))
+            points.extend(anchors)
+            labels.extend([label] * len(anchors))
+    return np.array(points, dtype=np.float32).reshape(-1, 2), np.array(labels, dtype=np.int32)
+
+# Boxes from every rectangular stroke of every path in boxPathDict
+def getAllBoxCos(boxPathDict):
+    boxes = []
+    for pathName in sorted(boxPathDict):
+        try:
+            strokes = getStrokePoints(boxPathDict[pathName])
+        except (AttributeError, IndexError) as e:
+            logging.error(f"Error accessing path data: {str(e)}")
+            continue
+        for points in strokes:
+            box = strokeToBox(points)
+            if box is not None:
+                boxes.append(box)
+    return boxes
+
 def getBoxCos(image, boxPathDict, pathName):
     path = boxPathDict.get(pathName)
     if path is None:
@@ -289,21 +666,15 @@ def getBoxCos(image, boxPathDict, pathName):
         return None
 
     try:  # Handle potential errors with path access
-        strokes = path.strokes  # Access strokes
+        strokes = getStrokePoints(path)  # Access strokes
         if not strokes: # Check for empty strokes
             logging.error('Error: Path has no strokes.')
             return None
 
-        points = strokes[0].points[0]  # Access points
-        ptsCnt = len(points)
-
-        if ptsCnt != 24:
-            logging.error(f'Error: Path is not a box! {ptsCnt}')
-            return None
-
-        topLeft = [points[2], points[3]]
-        bottomRight = [points[14], points[15]]
-        return topLeft + bottomRight
+        box = strokeToBox(strokes[0])
+        if box is None:
+            logging.error(f'Error: Path is not a box! {len(strokes[0])}')
+        return box
     except (AttributeError, IndexError) as e: # Catch potential errors
         logging.error(f"Error accessing path data: {str(e)}")
         return None
@@ -320,8 +691,37 @@ class DialogValue:
         self.isRandomColor = False
         self.maskColor = [255, 0, 0, 255]
         self.selPtCnt = 10
+        self.selPtStrategy = 'Random'
         self.selBoxPathName = None
         self.formatBinary = False
+        self.useServer = True
+        self.serverIdleTimeout = DEFAULT_IDLE_TIMEOUT
+        self.serverModelBudget = DEFAULT_MODEL_BUDGET / 1024 ** 3  # GiB of models the server keeps loaded
+        self.embeddingCacheDir = None
+        self.cacheAutoResults = True
+        self.resultCacheDir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                           'segany', 'results')
+        self.resultCacheMb = 1024
+        self.exportMasks = False
+        self.outputMode = 'Layers'  # 'Layers' (one per mask) or 'Label Map' (one layer for all)
+        self.labelOrder = 'area'  # label map painting order, 'area' or 'score'
+        self.labelChannels = False
+        self.pipelineDepth = DEFAULT_QUEUE_DEPTH  # masks queued between streaming stages
+        self.profileMode = 'off'  # 'off', 'spans' or 'sampling'
+        self.autoPreset = 'Balanced'
+        self.autoOverrides = {}  # SamAutomaticMaskGenerator settings that replace the preset's
+        self.maskFilters = {}  # score/area/NMS/top-K filters applied before layers are created
+        self.largeImageMode = 'Off'
+        self.largeImageMinMP = 16
+        self.largeImageBudgetMB = 2048
+        self.largeImageRefineEdges = False
+        self.cpuMode = 'Off'  # 'Off', 'Int8' or 'BF16'
+        self.cpuThreads = 0  # 0 = torch default
+        self.cpuInteropThreads = 0
+        self.backend = 'PyTorch'  # see backendVals
+        self.onnxDir = None  # exported ONNX models, default next to the checkpoint
+        self.mmapWeights = False  # load weights converted to safetensors, memory-mapped
+        self.profileOutput = None
         
         try:
             with open(self.filepath, 'r') as f:
@@ -334,8 +734,36 @@ class DialogValue:
                 self.isRandomColor = data.get('isRandomColor', self.isRandomColor)
                 self.maskColor = data.get('maskColor', self.maskColor)
                 self.selPtCnt = data.get('selPtCnt', self.selPtCnt)
+                self.selPtStrategy = data.get('selPtStrategy', self.selPtStrategy)
                 self.selBoxPathName = data.get('selBoxPathName', self.selBoxPathName) # Added this
                 self.formatBinary = data.get('formatBinary', self.formatBinary) # Add this too.
+                self.useServer = data.get('useServer', self.useServer)
+                self.serverIdleTimeout = data.get('serverIdleTimeout', self.serverIdleTimeout)
+                self.serverModelBudget = data.get('serverModelBudget', self.serverModelBudget)
+                self.embeddingCacheDir = data.get('embeddingCacheDir', self.embeddingCacheDir)
+                self.cacheAutoResults = data.get('cacheAutoResults', self.cacheAutoResults)
+                self.resultCacheDir = data.get('resultCacheDir', self.resultCacheDir)
+                self.resultCacheMb = data.get('resultCacheMb', self.resultCacheMb)
+                self.exportMasks = data.get('exportMasks', self.exportMasks)
+                self.outputMode = data.get('outputMode', self.outputMode)
+                self.labelOrder = data.get('labelOrder', self.labelOrder)
+                self.labelChannels = data.get('labelChannels', self.labelChannels)
+                self.pipelineDepth = data.get('pipelineDepth', self.pipelineDepth)
+                self.profileMode = data.get('profileMode', self.profileMode)
+                self.autoPreset = data.get('autoPreset', self.autoPreset)
+                self.autoOverrides = data.get('autoOverrides', self.autoOverrides)
+                self.maskFilters = data.get('maskFilters', self.maskFilters)
+                self.largeImageMode = data.get('largeImageMode', self.largeImageMode)
+                self.largeImageMinMP = data.get('largeImageMinMP', self.largeImageMinMP)
+                self.largeImageBudgetMB = data.get('largeImageBudgetMB', self.largeImageBudgetMB)
+                self.largeImageRefineEdges = data.get('largeImageRefineEdges', self.largeImageRefineEdges)
+                self.cpuMode = data.get('cpuMode', self.cpuMode)
+                self.cpuThreads = data.get('cpuThreads', self.cpuThreads)
+                self.cpuInteropThreads = data.get('cpuInteropThreads', self.cpuInteropThreads)
+                self.backend = data.get('backend', self.backend)
+                self.onnxDir = data.get('onnxDir', self.onnxDir)
+                self.mmapWeights = data.get('mmapWeights', self.mmapWeights)
+                self.profileOutput = data.get('profileOutput', self.profileOutput)
         except FileNotFoundError:
             logging.info(f"Configuration file not found: {self.filepath}")
         except json.JSONDecodeError as e:
@@ -598,6 +1026,15 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
         selPtsEntry.connect('key-press-event', kepPressNum)
         selPtsEntry.set_text(str(selPtCnt))  # Set a default value
 
+        selPtStrategyLbl = getRightAlignLabel('Point Sampling:')
+        selPtStrategyDropDown = Gtk.ComboBoxText()
+        for value in selPtStrategyVals:
+            selPtStrategyDropDown.append_text(value)
+        try:
+            selPtStrategyDropDown.set_active(selPtStrategyVals.index(values.selPtStrategy))
+        except ValueError:
+            selPtStrategyDropDown.set_active(0)
+
         boxPathNameLbl, boxPathNameDropDown = None, None
         if boxPathExist:
             boxPathNameLbl = getRightAlignLabel('Box Path:')
@@ -609,7 +1046,7 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
         # All things in the segType group.    
         segTypeLbl = getRightAlignLabel('Segmentation Type:')
         segTypeDropDown = Gtk.ComboBoxText()  # Modern ComboBox
-        segTypeVals = ['Auto', 'Selection', 'Box-Selection', 'Box'] # Add this line! Define
+        segTypeVals = ['Auto', 'Selection', 'Box-Selection', 'Box', 'Multi-Box', 'Interactive'] # Add this line! Define
         segTypeDropDown.connect('changed', functools.partial(self.onSegTypeChanged,
                                                              segTypeDropDown, segTypeVals,
                                                              [[selPtsLbl, selPtsEntry], [boxPathNameLbl, boxPathNameDropDown]],
@@ -640,9 +1077,108 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
             randColBtn.set_active(isRandomColor)
             randColBtn.connect('toggled', onRandomToggled, [maskColorLbl, maskColorBtn])
 
+        # Auto mode speed/quality preset, with per-setting overrides under Advanced
+        autoPresetLbl = getRightAlignLabel('Auto Preset:')
+        autoPresetDropDown = Gtk.ComboBoxText()
+        for value in autoPresetVals:
+            autoPresetDropDown.append_text(value)
+        try:
+            autoPresetDropDown.set_active(autoPresetVals.index(values.autoPreset))
+        except ValueError:
+            autoPresetDropDown.set_active(autoPresetVals.index('Balanced'))
+
+        autoAdvanced = Gtk.Expander(label='Advanced Auto Settings')
+        autoGrid = Gtk.Grid()
+        autoGrid.set_column_spacing(5)
+        autoGrid.set_row_spacing(5)
+        autoEntries = {}
+        for paramIdx, paramName in enumerate(AUTO_PARAM_TYPES):
+            paramEntry = Gtk.Entry()
+            paramEntry.set_placeholder_text('preset')
+            override = values.autoOverrides.get(paramName)
+            if override is not None:
+                paramEntry.set_text(str(override))
+            autoGrid.attach(getRightAlignLabel(paramName + ':'), 0, paramIdx, 1, 1)
+            autoGrid.attach(paramEntry, 1, paramIdx, 1, 1)
+            autoEntries[paramName] = paramEntry
+        autoAdvanced.add(autoGrid)
+
+        # Post-filters that cut overlapping, tiny or low scoring masks before they become layers
+        maskFilters = Gtk.Expander(label='Mask Filters')
+        filterGrid = Gtk.Grid()
+        filterGrid.set_column_spacing(5)
+        filterGrid.set_row_spacing(5)
+        filterEntries = {}
+        for paramIdx, paramName in enumerate(MASK_FILTER_TYPES):
+            paramEntry = Gtk.Entry()
+            paramEntry.set_placeholder_text('off')
+            setting = values.maskFilters.get(paramName)
+            if setting:
+                paramEntry.set_text(str(setting))
+            filterGrid.attach(getRightAlignLabel(paramName + ':'), 0, paramIdx, 1, 1)
+            filterGrid.attach(paramEntry, 1, paramIdx, 1, 1)
+            filterEntries[paramName] = paramEntry
+        maskFilters.add(filterGrid)
+
+        # Large image handling for Auto mode (budget and threshold live in the settings file)
+        largeImageLbl = getRightAlignLabel('Large Image Mode:')
+        largeImageDropDown = Gtk.ComboBoxText()
+        for value in largeImageModeVals:
+            largeImageDropDown.append_text(value)
+        try:
+            largeImageDropDown.set_active(largeImageModeVals.index(values.largeImageMode))
+        except ValueError:
+            largeImageDropDown.set_active(0)
+
+        # CPU inference mode (thread counts live in the settings file)
+        cpuModeLbl = getRightAlignLabel('CPU Mode:')
+        cpuModeDropDown = Gtk.ComboBoxText()
+        for value in cpuModeVals:
+            cpuModeDropDown.append_text(value)
+        try:
+            cpuModeDropDown.set_active(cpuModeVals.index(values.cpuMode))
+        except ValueError:
+            cpuModeDropDown.set_active(0)
+
+        # Inference backend for prompt decoding
+        backendNames = list(backendVals)
+        backendLbl = getRightAlignLabel('Backend:')
+        backendDropDown = Gtk.ComboBoxText()
+        for value in backendNames:
+            backendDropDown.append_text(value)
+        try:
+            backendDropDown.set_active(backendNames.index(values.backend))
+        except ValueError:
+            backendDropDown.set_active(0)
+        mmapWeightsCheckBox = Gtk.CheckButton(label='Memory-map Converted Weights')
+        mmapWeightsCheckBox.set_active(values.mmapWeights)
+        cacheAutoResultsCheckBox = Gtk.CheckButton(label='Cache Auto Results')
+        cacheAutoResultsCheckBox.set_active(values.cacheAutoResults)
+
         # Create the Format Binary checkbox:
         formatBinaryCheckBox = Gtk.CheckButton(label='Format Binary')  # Add a label
         formatBinaryCheckBox.set_active(values.formatBinary)  # Set initial state
+
+        # Masks are handed to the plugin in memory; .seg files are only written on request
+        exportMasksCheckBox = Gtk.CheckButton(label='Export Mask Files')
+        exportMasksCheckBox.set_active(values.exportMasks)
+
+        # One layer per mask, or all masks resolved into a single label map layer
+        outputModeLbl = getRightAlignLabel('Output:')
+        outputModeDropDown = Gtk.ComboBoxText()
+        for value in outputModeVals:
+            outputModeDropDown.append_text(value)
+        try:
+            outputModeDropDown.set_active(outputModeVals.index(values.outputMode))
+        except ValueError:
+            outputModeDropDown.set_active(0)
+        labelOrderLbl = getRightAlignLabel('Label Order:')
+        labelOrderDropDown = Gtk.ComboBoxText()
+        for value in labelOrderVals:
+            labelOrderDropDown.append_text(value)
+        labelOrderDropDown.set_active(1 if values.labelOrder == 'score' else 0)
+        labelChannelsCheckBox = Gtk.CheckButton(label='Channel per Label')
+        labelChannelsCheckBox.set_active(values.labelChannels)
         
         # Layout (Updated - Use Gtk.Grid)
         grid = Gtk.Grid()
@@ -674,6 +1210,10 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
         grid.attach(selPtsLbl, 0, rowIdx, 1, 1)
         grid.attach(selPtsEntry, 1, rowIdx, 1, 1)
         rowIdx += 1
+
+        grid.attach(selPtStrategyLbl, 0, rowIdx, 1, 1)
+        grid.attach(selPtStrategyDropDown, 1, rowIdx, 1, 1)
+        rowIdx += 1
         # ... (Attach other widgets to the grid similarly)
 
         if boxPathExist: # Updated layout
@@ -692,8 +1232,50 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
             onRandomToggled(randColBtn, [maskColorLbl, maskColorBtn])
 
         # ... (Layout code - add the checkbox to the dialog layout)
+        grid.attach(autoPresetLbl, 0, rowIdx, 1, 1)
+        grid.attach(autoPresetDropDown, 1, rowIdx, 1, 1)
+        rowIdx += 1
+
+        grid.attach(autoAdvanced, 0, rowIdx, 2, 1)
+        rowIdx += 1
+
+        grid.attach(maskFilters, 0, rowIdx, 2, 1)
+        rowIdx += 1
+
+        grid.attach(largeImageLbl, 0, rowIdx, 1, 1)
+        grid.attach(largeImageDropDown, 1, rowIdx, 1, 1)
+        rowIdx += 1
+
+        grid.attach(cpuModeLbl, 0, rowIdx, 1, 1)
+        grid.attach(cpuModeDropDown, 1, rowIdx, 1, 1)
+        rowIdx += 1
+
+        grid.attach(backendLbl, 0, rowIdx, 1, 1)
+        grid.attach(backendDropDown, 1, rowIdx, 1, 1)
+        rowIdx += 1
+
+        grid.attach(mmapWeightsCheckBox, 0, rowIdx, 2, 1)
+        rowIdx += 1
+
+        grid.attach(cacheAutoResultsCheckBox, 0, rowIdx, 2, 1)
+        rowIdx += 1
+
         grid.attach(formatBinaryCheckBox, 0, rowIdx, 2, 1)  # Attach to grid
         rowIdx += 1
+
+        grid.attach(exportMasksCheckBox, 0, rowIdx, 2, 1)
+        rowIdx += 1
+
+        grid.attach(outputModeLbl, 0, rowIdx, 1, 1)
+        grid.attach(outputModeDropDown, 1, rowIdx, 1, 1)
+        rowIdx += 1
+
+        grid.attach(labelOrderLbl, 0, rowIdx, 1, 1)
+        grid.attach(labelOrderDropDown, 1, rowIdx, 1, 1)
+        rowIdx += 1
+
+        grid.attach(labelChannelsCheckBox, 0, rowIdx, 2, 1)
+        rowIdx += 1
         
         # ... (Rest of the dialog setup)
 
@@ -723,18 +1305,41 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
         while True: # Updated
             response = dialog.run()
             if response == Gtk.ResponseType.OK:
-                values.pythonPath = pythonFileBtn.get_label()  # Get filename from button label
+                # pythonPath and checkPtPath hold the full paths set by the file chooser callbacks
                 values.modelType = modelTypeVals[modelTypeDropDown.get_active()]
-                values.checkPtPath = checkPtFileBtn.get_label()  # Get filename from button label
                 values.segType = segTypeVals[segTypeDropDown.get_active()]
                 values.maskType = maskTypeVals[maskTypeDropDown.get_active()]
                 if not isGrayScale:
                     maskColor = maskColorBtn.get_rgba()
                     values.maskColor = maskColor
+                    values.isRandomColor = randColBtn.get_active()
                 values.selPtCnt = int(selPtsEntry.get_text())
+                values.selPtStrategy = selPtStrategyVals[selPtStrategyDropDown.get_active()]
                 if boxPathExist:
                     values.selBoxPathName = boxPathNames[boxPathNameDropDown.get_active()]
                 values.formatBinary = formatBinaryCheckBox.get_active()    
+                values.exportMasks = exportMasksCheckBox.get_active()
+                values.outputMode = outputModeVals[outputModeDropDown.get_active()]
+                values.labelOrder = labelOrderVals[labelOrderDropDown.get_active()].lower()
+                values.labelChannels = labelChannelsCheckBox.get_active()
+                values.largeImageMode = largeImageModeVals[largeImageDropDown.get_active()]
+                values.cpuMode = cpuModeVals[cpuModeDropDown.get_active()]
+                values.backend = backendNames[backendDropDown.get_active()]
+                values.mmapWeights = mmapWeightsCheckBox.get_active()
+                values.cacheAutoResults = cacheAutoResultsCheckBox.get_active()
+                values.autoPreset = autoPresetVals[autoPresetDropDown.get_active()]
+                try:
+                    values.autoOverrides = {name: AUTO_PARAM_TYPES[name](entry.get_text())
+                                            for name, entry in autoEntries.items() if entry.get_text().strip()}
+                except ValueError as e:
+                    showError(f'Invalid advanced auto setting: {e}')
+                    continue
+                try:
+                    values.maskFilters = {name: MASK_FILTER_TYPES[name](entry.get_text())
+                                          for name, entry in filterEntries.items() if entry.get_text().strip()}
+                except ValueError as e:
+                    showError(f'Invalid mask filter: {e}')
+                    continue
                 valid = validateOptions(image, values) # Need to see this
                 if not valid:
                     continue
@@ -763,25 +1368,104 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
         level = logging.DEBUG
         configLogging(level)
 
-        # Redirect sys.settrace output to a file
-        trace_file = open("/tmp/gimp_trace.log", "w")  # Open a file for writing
-
-        def trace_calls(frame, event, arg):
-            if event == 'call':
-                trace_file.write(f"Call to {frame.f_code.co_name} in {frame.f_code.co_filename}:{frame.f_code.co_firstlineno}\n")
-            elif event == 'return':
-                trace_file.write(f"Return from {frame.f_code.co_name} in {frame.f_code.co_filename}:{frame.f_code.co_firstlineno}\n")
-            return trace_calls
-
-        sys.settrace(trace_calls)
-
         # 1. Get parameters from the dialog:
         boxPathDict = getPathDict(image)
         values = self.optionsDialog(image, boxPathDict)
         if values is None:  # Cancelled
-            sys.settrace(None) # Disable tracing
             return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
 
+        # Opt-in stage timing (profileMode 'spans' or 'sampling' in the settings file)
+        if values.profileMode in PROFILE_MODES[1:]:
+            profiler.start(values.profileMode)
+        try:
+            with profiler.span('total'):
+                return self.segment(procedure, image, values, boxPathDict)
+        finally:
+            if profiler.enabled:
+                report = profiler.stop()
+                profiler.write_report(values.profileOutput or
+                                      os.path.join(tempfile.gettempdir(), 'segany_profile.json'), report)
+
+    # Interactive refinement: a non-modal dialog stays open while the user adds anchors to
+    # the SAM+ / SAM- paths; each Update decodes once (reusing the embedding and the previous
+    # low-res logits) and rewrites the same layer in place.
+    def refineInteractively(self, image, processor, imagePixels, userSelColor, progress):
+        if image.get_base_type() == Gimp.ImageBaseType.GRAY:
+            layerType, bablFormat, color = Gimp.ImageType.GRAYA_IMAGE, "Y'A u8", [100, 255]
+        else:
+            layerType, bablFormat = Gimp.ImageType.RGBA_IMAGE, "R'G'B'A u8"
+            color = userSelColor if userSelColor is not None else list(getRandomColor(1)[0]) + [255]
+
+        # The image encoder runs on a worker thread under the progress dialog, which
+        # can cancel it and closes once the session is ready
+        progress.update('embedding')
+        sessionId = progress.run(processor.start_session, imagePixels)
+        progress.close()
+        try:
+            progress.task.check()
+        except SegmentationCancelled:
+            processor.end_session(sessionId)
+            raise
+        layer = Gimp.Layer.new(image, "Segment Refine", 1, 1, layerType, 50, Gimp.LayerMode.NORMAL)
+        image.insert_layer(layer, None, 0)
+
+        # The layer is resized to each mask's bounding box (1x1 and empty while there is no mask)
+        def showMask(record):
+            mask, (x, y, w, h) = (None, (0, 0, 0, 0)) if record is None else getMaskCrop(record)
+            if w == 0 or h == 0:
+                mask, (x, y, w, h) = np.zeros((1, 1), dtype=bool), (0, 0, 1, 1)
+            layer.resize(w, h, 0, 0)
+            layer.set_offsets(x, y)
+            writeMaskToBuffer(layer.get_buffer(), mask, color, bablFormat)
+            layer.update(0, 0, w, h)
+            Gimp.displays_flush()
+            status.set_text('No mask yet' if record is None else f"Score {record['score']:.3f}")
+
+        dialog = Gtk.Dialog('Segment Anything Refinement', None, modal=False)
+        dialog.vbox.pack_start(Gtk.Label(label=f"Add anchors to the '{REFINE_POSITIVE_PATH}' path to include "
+                                               f"and to the '{REFINE_NEGATIVE_PATH}' path to exclude,\n"
+                                               "then press Update."), False, False, 5)
+        status = Gtk.Label(label='No mask yet')
+        dialog.vbox.pack_start(status, False, False, 5)
+        updateResponse, undoResponse = 1, 2
+        dialog.add_button('Update', updateResponse)
+        dialog.add_button('Undo', undoResponse)
+        dialog.add_button(Gtk.STOCK_OK, Gtk.ResponseType.OK)
+        dialog.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        dialog.show_all()
+
+        # Decoding (or the round trip to the model server) runs on a worker thread
+        # with the dialog disabled, so GIMP keeps redrawing meanwhile
+        def runSessionCall(func, *args):
+            status.set_text('Updating...')
+            dialog.set_sensitive(False)
+            try:
+                return runOnWorker(pumpEvents, func, *args)
+            finally:
+                dialog.set_sensitive(True)
+
+        try:
+            while True:
+                response = dialog.run()
+                if response == updateResponse:
+                    points, labels = getRefinePoints(image)
+                    if len(points) == 0:
+                        status.set_text(f"No anchors on '{REFINE_POSITIVE_PATH}' / '{REFINE_NEGATIVE_PATH}'")
+                        continue
+                    with profiler.span('refine_update'):
+                        showMask(runSessionCall(processor.update_session, sessionId, points, labels))
+                elif response == undoResponse:
+                    showMask(runSessionCall(processor.undo_session, sessionId))
+                else:
+                    if response != Gtk.ResponseType.OK:
+                        image.remove_layer(layer)
+                    break
+        finally:
+            dialog.destroy()
+            processor.end_session(sessionId)
+
+    # Segmentation and layer creation for the options chosen in the dialog
+    def segment(self, procedure, image, values, boxPathDict):
         # 2. Use the parameters in your plugin logic:
         # Example: Accessing values from the dialog:
         pythonPath = values.pythonPath
@@ -795,7 +1479,8 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
         selBoxPathName = values.selBoxPathName
         formatBinary = values.formatBinary
 
-        # Example: Using the image and drawables:
+        # Model loading, inference and export run on a worker thread behind this progress
+        progress = None
         try:   
             width = image.get_width()
             height = image.get_height()
@@ -815,97 +1500,82 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
                 layer_name = layer.get_name()
                 if layer_name is None: # Example of checking for an error condition.
                     raise ValueError("Layer name is None")
-            # Initialize SegmentAnythingProcessor
-            processor = SegmentAnythingProcessor(modelType, checkPtPath)
+            # Use the long-lived model server so the checkpoint is only loaded once,
+            # or load SegmentAnythingProcessor in-process if the server is disabled
+            progress = SegmentationProgress("Segment Anything")
+            progress.update('model_load')
+            if values.useServer:
+                processor = SegmentAnythingClient(modelType, checkPtPath, pythonPath,
+                                                  values.serverIdleTimeout,
+                                                  embedding_cache_dir=values.embeddingCacheDir,
+                                                  processor_options=getProcessorOptions(values),
+                                                  model_budget=int(values.serverModelBudget * 1024 ** 3))
+                progress.run(processor.ensure_running)
+            else:
+                # torch and segment_anything are imported on the worker thread as well
+                def loadProcessor():
+                    from seganybridge import SegmentAnythingProcessor
+                    return SegmentAnythingProcessor(modelType, checkPtPath,
+                                                    embedding_cache_dir=values.embeddingCacheDir,
+                                                    **getProcessorOptions(values))
+                processor = progress.run(loadProcessor)
 
             # Prepare arguments for run_segmentation
-            image_path = image.get_file().get_path() if image.get_file() else tempfile.NamedTemporaryFile(suffix=".png").name
-            sel_file = None
+            with profiler.span('image_read'):
+                imagePixels = getImagePixels(image)
+            points = None
             box_cos = None
 
-            if segType == 'Selection':
-                temp_sel_file = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.sel')
-                if exportSelection(image, temp_sel_file.name, selPtCnt):
-                    sel_file = temp_sel_file.name
-                else:
+            if segType in {'Selection', 'Box-Selection'}:
+                points = getSelectionPoints(image, selPtCnt, values.selPtStrategy)
+                if len(points) == 0:
                     return return_plugin_error(procedure, f"Selection export failed.")
-                temp_sel_file.close()
-            elif segType == 'Box-Selection' or segType == 'Box':
+            if segType == 'Multi-Box':
+                # Every rectangular stroke of every path, decoded in one batch
+                box_cos = getAllBoxCos(boxPathDict)
+                if not box_cos:
+                    return return_plugin_error(procedure, f"No box paths found.")
+            if segType == 'Box-Selection' or segType == 'Box':
                 box_cos = getBoxCos(image, boxPathDict, selBoxPathName)
                 if not box_cos:
                     return return_plugin_error(procedure, f"Box coordinates retrieval failed.")
 
-            # Run segmentation using SegmentAnythingProcessor
-            processor.run_segmentation(
-                image_path,
-                segType,
-                maskType,
-                maskFileNoExt,
-                'True' if formatBinary else 'False',
-                sel_file=sel_file,
-                box_cos=box_cos
-            )
-            # Note; there is an unknown issue the SAM code where upon return, it would never execute this layer
-            # Call createLayers with the correct arguments
-            # layerCount = createLayers(image, maskFileNoExt, values.userSelColor, formatBinary)
-            # logging.info(f"{layerCount} layers created.")
-            # So instead, lets try inlining it.
+            if segType == 'Interactive':
+                userSelColor = None if isRandomColor else getColorList(maskColor)
+                self.refineInteractively(image, processor, imagePixels, userSelColor, progress)
+                return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS)
+
+            # Run segmentation using SegmentAnythingProcessor. The masks come back as NumPy
+            # arrays; .seg files next to the image are only written in export mode.
+            segmentArgs = (imagePixels, segType, maskType, maskFileNoExt if values.exportMasks else None,
+                           formatBinary)
+            segmentKwargs = dict(box_cos=box_cos, points=points, large_image=getLargeImageOptions(values),
+                                 auto_preset=values.autoPreset, auto_overrides=values.autoOverrides,
+                                 mask_filters=values.maskFilters, task=progress.task,
+                                 **getResultCacheOptions(values))
+            userSelColor = None if isRandomColor else getColorList(maskColor)
+            if values.outputMode == 'Label Map':
+                masks = progress.run(processor.run_segmentation, *segmentArgs, output='labels',
+                                     label_order=values.labelOrder, **segmentKwargs)
+                with profiler.span('layer_creation'):
+                    layerCount = createLabelLayer(image, masks[0], values.labelChannels, progress)
+                logging.info(f"Label map with {layerCount} labels created.")
+            else:
+                # Masks stream in as they are produced (and unpacked, when they come from the
+                # server) on one worker thread, get rendered into layer pixels on another and
+                # become layers here on the main thread; at most pipelineDepth masks wait
+                # between two stages.
+                records = processor.iter_segmentation(*segmentArgs, crop_masks=True, **segmentKwargs)
+                pipeline = Pipeline(records, [MaskRenderer(getLayerFormat(image, userSelColor)[2])],
+                                    values.pipelineDepth, progress.task, progress.pump)
+                try:
+                    with profiler.span('layer_creation'):
+                        layerCount = createLayers(image, pipeline, userSelColor, progress=progress)
+                finally:
+                    pipeline.close()
+                logging.info(f"{layerCount} layers created.")
             print("Flushing Display") # debug print.
             Gimp.Display.flush() # Force display update.
-
-            print("Creating Layers Inline") # debug print
-
-            # Start move createLayer logic inline.
-            width, height = image.get_width(), image.get_height()
-            logging.info(f"In createLayers: {maskFileNoExt}")
-            idx = 0
-            maxLayers = 99999
-            print("Before parent")
-            parent = Gimp.LayerGroup.new(image)
-            print("After parent")
-            image.insert_layer(parent, None, 0)
-            parent.set_opacity(50)
-
-            uniqueColors = getRandomColor(layerCnt=999)
-
-            if image.get_base_type() == Gimp.ImageType.GRAY:
-                layerType = Gimp.ImageType.GRAYA
-                userSelColor = [100, 255]
-            else:
-                layerType = Gimp.ImageType.RGBA
-            logging.info(f"createLayers: {width},{height} {maskFileNoExt}")
-
-            while idx < maxLayers:
-                filepath = maskFileNoExt + str(idx) + '.seg'
-                logging.debug(f"Layer source filepath: {filepath}")
-                if os.path.exists(filepath):
-                    logging.info(f"Creating Layer: {(idx + 1)}")
-                    newlayer = Gimp.Layer.new(image, f"Segment Auto {idx}", layerType, 100, Gimp.LayerMode.NORMAL)
-                    image.insert_layer(newlayer, parent, 0)
-                    newlayer.set_visible(False)
-                    buffer = newlayer.get_buffer()
-
-                    maskVals = readMaskFile(filepath, formatBinary)
-                    maskColor = userSelColor if userSelColor is not None else list(uniqueColors[idx]) + [255]
-
-                    buffer.begin_write()
-                    for y, line in enumerate(maskVals):
-                        for x, p in enumerate(line):
-                            if p:
-                                buffer.set_pixel(x, y, maskColor)
-                            else:
-                                buffer.set_pixel(x, y, [0, 0, 0, 0] if layerType == Gimp.ImageType.RGBA else [0, 0])
-                    buffer.end_write()
-
-                    newlayer.flush()
-                    newlayer.merge_shadow(True)
-                    newlayer.update(0, 0, width, height)
-
-                else:
-                    break
-                idx += 1
-
-            logging.info(f"{idx} layers created.") # layerCount logging.
  
         except AttributeError as e:
             try:
@@ -927,12 +1597,24 @@ class SegAny(Gimp.PlugIn):  # Inherit from Gimp.PlugIn
         except json.JSONDecodeError as e:
             return return_plugin_error(procedure, "Invalid JSON format in configuration file.")  # Use helper function
 
+        except SegmentationCancelled:
+            # Exported .seg files and partial layers are already removed
+            Gimp.displays_flush()
+            return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
+
+        except SegmentAnythingServerError as e:
+            return return_plugin_error(procedure, f"Segmentation server error: {e}")
+
         except subprocess.CalledProcessError as e:
             return return_plugin_error(procedure, "An error occurred during segmentation. Please check the plugin settings.")  # Use helper
 
         except Exception as e:
             return return_plugin_error(procedure, "An unexpected error occurred. Please check the pluin logs for details.")
 
+        finally:
+            if progress is not None:
+                progress.close()
+
         return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS)
 
 # Register the plugin with GIMP.   It's just not that simple anymore.
@@ -0,0 +1,657 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Offline benchmarks for seganybridge.py and the plugin's mask/layer code.
+
+Runs without GIMP and without a SAM checkpoint: segment_anything is replaced
+by a stub model that returns synthetic masks, and gi.repository by a fake
+Gimp/Gegl module whose buffers only count the bytes written. Each benchmark
+runs over synthetic images of several sizes and mask counts and reports the
+best wall time, throughput and peak traced memory. Results are written as
+JSON tagged with the git commit so runs can be compared across commits:
+
+    python3 seganybench.py --output before.json
+    python3 seganybench.py --output after.json --compare before.json
+
+The stub model still needs numpy, torch and cv2 to be installed, as
+seganybridge.py imports them.
+
+With --cpu-modes the real model is loaded instead, once per CPU mode, to
+compare encoder and decoder latency and the masks of a grid of point
+prompts against fp32 (mean and worst IoU):
+
+    python3 seganybench.py --cpu-modes fp32 int8 bf16 onnx \
+        --checkpoint sam_vit_b_01ec64.pth --model-type vit_b --image photo.jpg
+
+With --load-times the checkpoint is loaded in fresh interpreters: from the
+.pth, converted to memory-mapped safetensors (cold, includes the one-time
+conversion) and from the converted file (warm), reporting load time and
+peak RSS:
+
+    python3 seganybench.py --load-times --checkpoint sam_vit_h_4b8939.pth --model-type vit_h
+
+With --startup, segany.py is imported in fresh interpreters the way GIMP
+does at every launch, reporting import time and peak RSS. It exits with
+status 1 if torch, cv2, segment_anything or seganybridge got imported, or
+if the import took longer than --startup-budget seconds:
+
+    python3 seganybench.py --startup --startup-budget 1.0
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+DEFAULT_SIZES = ['512x512', '2048x1536', '6000x4000']
+# SegmentAnythingProcessor keyword options for each --cpu-modes entry
+CPU_MODES = {
+    'fp32': {},
+    'int8': {'cpu_options': {'quantize': True}},
+    'bf16': {'cpu_options': {'bf16': True}},
+    'onnx': {'backend': 'onnx'},
+    'onnx-full': {'backend': 'onnx-full'},
+}
+DEFAULT_MASK_COUNTS = [1, 10, 50]
+# Modules segany.py must not import when GIMP queries the plugin
+STARTUP_HEAVY_MODULES = ['torch', 'cv2', 'segment_anything', 'seganybridge', 'onnxruntime']
+# Run in a fresh interpreter; the fake gi.repository is only used without a real one
+STARTUP_SCRIPT = '''
+import importlib.util, json, resource, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {directory!r})
+gi = 'real' if importlib.util.find_spec('gi') else 'fake'
+if gi == 'fake':
+    import seganybench
+    seganybench.install_fake_gimp()
+import segany
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'gi': gi,
+                  'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                  'heavy_modules': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+STUB_EMBEDDING_SHAPE = (1, 256, 64, 64)
+
+
+def synthetic_image(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def synthetic_masks(width, height, count, seed=0):
+    # Random ellipses, roughly the size distribution of SAM auto masks
+    rng = np.random.default_rng(seed)
+    ys = np.arange(height, dtype=np.float32)[:, None]
+    xs = np.arange(width, dtype=np.float32)[None, :]
+    masks = []
+    for _ in range(count):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        rx, ry = rng.uniform(0.02, 0.3) * width, rng.uniform(0.02, 0.3) * height
+        masks.append(((xs - cx) / rx) ** 2 + ((ys - cy) / ry) ** 2 <= 1.0)
+    return masks
+
+
+# Stub segment_anything
+
+class StubSam:
+    def __init__(self, checkpoint=None):
+        self.checkpoint = checkpoint
+        self.device = 'cpu'
+        self.mask_count = DEFAULT_MASK_COUNTS[-1]
+
+    def to(self, device=None, **kwargs):
+        self.device = device or self.device
+        return self
+
+
+class StubSamPredictor:
+    def __init__(self, sam):
+        self.model = sam
+        self.reset_image()
+
+    def reset_image(self):
+        self.is_image_set = False
+        self.features = None
+        self.original_size = None
+        self.input_size = None
+
+    def set_image(self, image, image_format='RGB'):
+        import torch
+        self.features = torch.zeros(STUB_EMBEDDING_SHAPE)
+        self.original_size = image.shape[:2]
+        self.input_size = image.shape[:2]
+        self.is_image_set = True
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True, return_logits=False):
+        height, width = self.original_size
+        count = 3 if multimask_output else 1
+        masks = np.stack(synthetic_masks(width, height, count))
+        scores = np.linspace(0.9, 0.7, count).astype(np.float32)
+        logits = np.zeros((count, 256, 256), dtype=np.float32)
+        return masks, scores, logits
+
+
+class StubSamAutomaticMaskGenerator:
+    def __init__(self, model, points_per_side=32, points_per_batch=64, crop_n_layers=0, **kwargs):
+        self.model = model
+        self.kwargs = kwargs
+        self.points_per_batch = points_per_batch
+        self.point_grids = [np.zeros((points_per_side ** 2, 2))] * (crop_n_layers + 1)
+
+    def generate(self, image):
+        height, width = image.shape[:2]
+        records = []
+        for mask in synthetic_masks(width, height, self.model.mask_count):
+            ys, xs = np.nonzero(mask)
+            # Like SAM, width and height are max - min (one pixel short of the extent)
+            bbox = [int(xs.min()), int(ys.min()), int(np.ptp(xs)), int(np.ptp(ys))] if xs.size else [0, 0, 0, 0]
+            records.append({'segmentation': mask, 'area': int(xs.size), 'bbox': bbox,
+                            'predicted_iou': 0.9, 'stability_score': 0.95})
+        return records
+
+
+def install_stub_sam():
+    module = types.ModuleType('segment_anything')
+    module.sam_model_registry = {name: StubSam for name in ['default', 'vit_h', 'vit_l', 'vit_b']}
+    module.SamPredictor = StubSamPredictor
+    module.SamAutomaticMaskGenerator = StubSamAutomaticMaskGenerator
+    sys.modules['segment_anything'] = module
+    return module
+
+
+# Fake gi.repository
+
+class FakeBuffer:
+    def __init__(self):
+        self.bytes_written = 0
+        self.set_calls = 0
+
+    def set(self, rect, babl_format, data):
+        self.bytes_written += len(data)
+        self.set_calls += 1
+
+    def set_pixel(self, x, y, color):
+        self.bytes_written += len(color)
+        self.set_calls += 1
+
+    def get(self, rect, scale, babl_format, abyss_policy):
+        x, y, width, height = rect
+        return bytes(width * height * (3 if babl_format.startswith("R'G'B' ") else 1))
+
+    def flush(self):
+        pass
+
+
+class FakeDrawable:
+    def __init__(self, image, name='', width=0, height=0, *args):
+        self.image = image
+        self.name = name
+        self.width = width
+        self.height = height
+        self.offsets = (0, 0)
+        self.buffer = FakeBuffer()
+        self.visible = True
+
+    def get_buffer(self):
+        return self.buffer
+
+    def get_shadow_buffer(self):
+        return self.buffer
+
+    def set_visible(self, visible):
+        self.visible = visible
+
+    def set_opacity(self, opacity):
+        pass
+
+    def set_offsets(self, x, y):
+        self.offsets = (x, y)
+
+    def set_name(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+    def update(self, *args):
+        pass
+
+    def merge_shadow(self, *args):
+        pass
+
+    def delete(self):
+        pass
+
+
+class FakeImage:
+    def __init__(self, width, height, gray=False):
+        self.width = width
+        self.height = height
+        self.gray = gray
+        self.layers = []
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+    def get_base_type(self):
+        return 'GRAY' if self.gray else 'RGB'
+
+    def insert_layer(self, layer, parent, position):
+        self.layers.append(layer)
+
+    def remove_layer(self, layer):
+        self.layers.remove(layer)
+
+    def get_layers(self):
+        return list(self.layers)
+
+    def get_file(self):
+        return None
+
+
+def install_fake_gimp():
+    class PlugIn:
+        __gtype__ = None
+
+    class LayerGroup(FakeDrawable):
+        @staticmethod
+        def new(image, *args):
+            return LayerGroup(image)
+
+    class Layer(FakeDrawable):
+        @staticmethod
+        def new(image, name, width, height, *args):
+            return Layer(image, name, width, height)
+
+        @staticmethod
+        def new_from_visible(image, dest_image, name):
+            return Layer(image, name, image.get_width(), image.get_height())
+
+    class Rectangle(tuple):
+        @staticmethod
+        def new(x, y, width, height):
+            return Rectangle((x, y, width, height))
+
+    class RGBA:
+        red = green = blue = alpha = 1.0
+
+    enum = types.SimpleNamespace
+    gimp = types.SimpleNamespace(
+        PlugIn=PlugIn, main=lambda *args: 0, Layer=Layer, LayerGroup=LayerGroup,
+        ImageBaseType=enum(RGB='RGB', GRAY='GRAY'),
+        ImageType=enum(RGBA_IMAGE='RGBA_IMAGE', GRAYA_IMAGE='GRAYA_IMAGE'),
+        LayerMode=enum(NORMAL='NORMAL'),
+        PDBStatusType=enum(SUCCESS=0, CANCEL=1, EXECUTION_ERROR=2),
+        Display=enum(flush=lambda: None))
+    gegl = types.SimpleNamespace(Rectangle=Rectangle, AbyssPolicy=enum(NONE=0, CLAMP=1))
+    gdk = types.SimpleNamespace(RGBA=RGBA)
+    repository = types.ModuleType('gi.repository')
+    for name, value in [('Gimp', gimp), ('Gegl', gegl), ('Gdk', gdk)]:
+        setattr(repository, name, value)
+    for name in ['GimpUi', 'GLib', 'GObject', 'Gio', 'Gtk']:
+        setattr(repository, name, types.SimpleNamespace())
+    gi = types.ModuleType('gi')
+    gi.require_version = lambda *args: None
+    gi.repository = repository
+    sys.modules['gi'] = gi
+    sys.modules['gi.repository'] = repository
+    return repository
+
+
+def load_modules():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    install_stub_sam()
+    install_fake_gimp()
+    import seganybridge
+    import segany
+    return seganybridge, segany
+
+
+# Measurement
+
+def measure(func, repeat):
+    # Best wall time over repeat runs and the traced peak of one run
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def bench_cases(bridge, segany, width, height, count, workdir):
+    processor = bridge.SegmentAnythingProcessor('vit_b', None)
+    processor.sam.mask_count = count
+    masks = synthetic_masks(width, height, count)
+    records = [{'segmentation': mask, 'score': 0.9, 'bbox': None} for mask in masks]
+    image = synthetic_image(width, height)
+    prefix = os.path.join(workdir, 'mask')
+    processor.save_masks(masks, prefix, True)
+    filepaths = [prefix + str(i) + '.seg' for i in range(count)]
+
+    def pack():
+        for i, mask in enumerate(masks):
+            processor.pack_bool_array(filepaths[i], mask)
+
+    def unpack():
+        for filepath in filepaths:
+            segany.unpackBoolArray(filepath)
+
+    def read_files():
+        for filepath in filepaths:
+            segany.readMaskFile(filepath, True)
+
+    def to_buffer():
+        for mask in masks:
+            segany.writeMaskToBuffer(FakeBuffer(), mask, [255, 0, 0, 255], "R'G'B'A u8")
+
+    def create_layers():
+        segany.createLayers(FakeImage(width, height), records, [255, 0, 0, 255])
+
+    def create_layers_pipeline():
+        # Rendering on a worker thread while the layers are inserted, as the plugin streams them
+        pipeline = segany.Pipeline(records, [segany.MaskRenderer([255, 0, 0, 255])])
+        try:
+            segany.createLayers(FakeImage(width, height), pipeline, [255, 0, 0, 255])
+        finally:
+            pipeline.close()
+
+    def run_auto():
+        processor.run_segmentation(image, 'Auto', 'Multiple')
+
+    result_cache_dir = os.path.join(workdir, 'results')
+    processor.run_segmentation(image, 'Auto', 'Multiple',
+                               result_cache_dir=result_cache_dir)  # fill the cache; the timed runs are hits
+
+    def run_auto_cached():
+        processor.run_segmentation(image, 'Auto', 'Multiple', result_cache_dir=result_cache_dir)
+
+    def run_box():
+        processor.run_segmentation(image, 'Box', 'Multiple', box_cos=[0, 0, width // 2, height // 2])
+
+    return [
+        ('pack_bool_array', pack, count),
+        ('save_masks', lambda: processor.save_masks(masks, prefix, True), count),
+        ('unpackBoolArray', unpack, count),
+        ('readMaskFile', read_files, count),
+        ('mask_to_buffer', to_buffer, count),
+        ('createLayers', create_layers, count),
+        ('createLayers_pipeline', create_layers_pipeline, count),
+        ('run_segmentation_auto', run_auto, count),
+        ('run_segmentation_auto_cached', run_auto_cached, count),
+        ('run_segmentation_box', run_box, 3),
+    ]
+
+
+# CPU modes against fp32 with a real checkpoint
+
+def mask_iou(a, b):
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.0
+
+
+def bench_cpu_modes(checkpoint, model_type, image_path, modes, repeat, threads=0, grid=4):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import seganybridge
+    image = seganybridge.load_image(image_path) if image_path else synthetic_image(1024, 768)
+    height, width = image.shape[:2]
+    points = [((i + 0.5) * width / grid, (j + 0.5) * height / grid) for j in range(grid) for i in range(grid)]
+
+    results = []
+    reference = None
+    for mode in (['fp32'] + [m for m in modes if m != 'fp32']):
+        start = time.perf_counter()
+        options = dict(CPU_MODES[mode])
+        options['cpu_options'] = dict(options.get('cpu_options', {}), threads=threads)
+        # No embedding cache, so every get_embedding runs the encoder
+        processor = seganybridge.SegmentAnythingProcessor(model_type, checkpoint, embedding_cache_bytes=0,
+                                                          **options)
+        load_seconds = time.perf_counter() - start
+        encode_seconds = measure(lambda: processor.get_embedding(image), repeat)[0]
+        entry = processor.get_embedding(image)
+
+        masks = []
+        start = time.perf_counter()
+        for point in points:
+            mask, _, _ = processor.predict(entry, point_coords=np.array([point]), point_labels=np.array([1]),
+                                           multimask_output=False)
+            masks.append(mask[0])
+        decode_seconds = (time.perf_counter() - start) / len(points)
+        if reference is None:
+            reference = masks
+        ious = [mask_iou(a, b) for a, b in zip(masks, reference)]
+        del processor, entry
+        gc.collect()
+
+        if mode not in modes:
+            continue
+        result = {
+            'name': f'cpu_{mode}', 'width': width, 'height': height, 'masks': len(points),
+            'seconds': encode_seconds, 'load_seconds': load_seconds,
+            'decode_seconds_per_prompt': decode_seconds,
+            'mean_iou': float(np.mean(ious)), 'min_iou': float(np.min(ious)),
+            'peak_bytes': 0,
+        }
+        results.append(result)
+        print(f"{result['name']:10s} load {load_seconds:7.2f} s  encode {encode_seconds * 1e3:9.1f} ms  "
+              f"decode {decode_seconds * 1e3:7.2f} ms/prompt  IoU mean {result['mean_iou']:.4f} "
+              f"min {result['min_iou']:.4f}")
+    return results
+
+
+# Checkpoint load times
+
+LOAD_SCRIPT = '''
+import json, resource, sys, time
+sys.path.insert(0, {directory!r})
+start = time.perf_counter()
+if {mmap!r}:
+    from seganyweights import load_sam
+    sam = load_sam({model_type!r}, {checkpoint!r}, {weights_dir!r})
+else:
+    from segment_anything import sam_model_registry
+    sam = sam_model_registry[{model_type!r}](checkpoint={checkpoint!r})
+print(json.dumps({{'seconds': time.perf_counter() - start,
+                  'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}}))
+'''
+
+
+def bench_load_times(checkpoint, model_type, repeat):
+    weights_dir = tempfile.mkdtemp(prefix='seganybench-weights-')
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def load(mmap):
+        script = LOAD_SCRIPT.format(directory=directory, mmap=mmap, model_type=model_type,
+                                    checkpoint=os.path.abspath(checkpoint), weights_dir=weights_dir)
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+        return json.loads(output.stdout.strip().splitlines()[-1])
+
+    results = []
+    try:
+        # The first mmap run converts the checkpoint, the later ones map the converted file
+        runs = [('load_pth', [load(False) for _ in range(repeat)]),
+                ('load_convert_cold', [load(True)]),
+                ('load_mmap_warm', [load(True) for _ in range(repeat)])]
+        for name, loads in runs:
+            best = min(loads, key=lambda run: run['seconds'])
+            result = {'name': name, 'width': 0, 'height': 0, 'masks': 0,
+                      'seconds': best['seconds'], 'peak_bytes': best['max_rss']}
+            results.append(result)
+            print(f"{name:24s} {model_type:>10s} {result['seconds']:10.2f} s "
+                  f"{result['peak_bytes'] / 2**20:9.1f} MiB RSS")
+    finally:
+        shutil.rmtree(weights_dir, ignore_errors=True)
+    return results
+
+
+# Plugin startup
+
+def bench_startup(repeat):
+    script = STARTUP_SCRIPT.format(directory=os.path.dirname(os.path.abspath(__file__)),
+                                   heavy=STARTUP_HEAVY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run['seconds'])
+    result = {
+        'name': 'startup_import', 'width': 0, 'height': 0, 'masks': 0,
+        'seconds': best['seconds'], 'peak_bytes': best['max_rss'],
+        'gi': best['gi'], 'heavy_modules': sorted({m for run in runs for m in run['heavy_modules']}),
+    }
+    print(f"{'startup_import':24s} {result['seconds'] * 1e3:10.2f} ms {result['peak_bytes'] / 2**20:9.1f} MiB RSS"
+          f"  gi {result['gi']}  heavy modules: {', '.join(result['heavy_modules']) or 'none'}")
+    return [result]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(sizes, mask_counts, repeat, only=None):
+    bridge, segany = load_modules()
+    results = []
+    workdir = tempfile.mkdtemp(prefix='seganybench-')
+    try:
+        for size in sizes:
+            width, height = (int(v) for v in size.lower().split('x'))
+            for count in mask_counts:
+                for name, func, masks in bench_cases(bridge, segany, width, height, count, workdir):
+                    if only and name not in only:
+                        continue
+                    seconds, peak = measure(func, repeat)
+                    megapixels = width * height * masks / 1e6
+                    result = {
+                        'name': name, 'width': width, 'height': height, 'masks': masks,
+                        'seconds': seconds, 'megapixels_per_second': megapixels / seconds if seconds else None,
+                        'masks_per_second': masks / seconds if seconds else None,
+                        'peak_bytes': peak,
+                    }
+                    results.append(result)
+                    print(f"{name:24s} {size:>10s} x{masks:<4d} {seconds * 1e3:10.2f} ms "
+                          f"{result['megapixels_per_second'] or 0:10.1f} MP/s {peak / 2**20:9.1f} MiB peak")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def result_key(result):
+    return (result['name'], result['width'], result['height'], result['masks'])
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    print(f"\nCompared with {baseline_path} (ratio > 1 is slower):")
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None or not old['seconds']:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        mem_ratio = result['peak_bytes'] / old['peak_bytes'] if old['peak_bytes'] else float('nan')
+        name, width, height, masks = result_key(result)
+        print(f"{name:24s} {width}x{height} x{masks:<4d} time {ratio:6.2f}x  memory {mem_ratio:6.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the Segment Anything plugin')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='Image sizes as WIDTHxHEIGHT')
+    parser.add_argument('--masks', nargs='+', type=int, default=DEFAULT_MASK_COUNTS, help='Mask counts')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case (best is kept)')
+    parser.add_argument('--only', nargs='+', default=None, help='Only run these benchmarks')
+    parser.add_argument('--output', default=None, help='Write results as JSON')
+    parser.add_argument('--compare', default=None, help='Baseline JSON from an earlier run')
+    parser.add_argument('--cpu-modes', nargs='+', default=None, choices=list(CPU_MODES),
+                        help='Compare CPU modes and backends with a real checkpoint instead')
+    parser.add_argument('--checkpoint', default=None, help='SAM checkpoint for --cpu-modes and --load-times')
+    parser.add_argument('--model-type', default='vit_b', help='Model type for --cpu-modes and --load-times')
+    parser.add_argument('--image', default=None, help='Image for --cpu-modes (default: synthetic)')
+    parser.add_argument('--threads', type=int, default=0, help='Intra-op threads for --cpu-modes')
+    parser.add_argument('--load-times', action='store_true',
+                        help='Compare .pth and memory-mapped checkpoint loads (needs --checkpoint)')
+    parser.add_argument('--startup', action='store_true', help='Measure the plugin import at GIMP startup instead')
+    parser.add_argument('--startup-budget', type=float, default=None,
+                        help='Fail --startup if the import takes longer than this many seconds')
+    args = parser.parse_args(argv)
+
+    status = 0
+    if args.startup:
+        results = bench_startup(args.repeat)
+        if results[0]['heavy_modules']:
+            print(f"FAIL: segany.py imported {', '.join(results[0]['heavy_modules'])} at startup")
+            status = 1
+        if args.startup_budget is not None and results[0]['seconds'] > args.startup_budget:
+            print(f"FAIL: startup import took {results[0]['seconds']:.2f} s "
+                  f"(budget {args.startup_budget:.2f} s)")
+            status = 1
+    elif args.load_times:
+        if not args.checkpoint:
+            parser.error('--load-times needs --checkpoint')
+        results = bench_load_times(args.checkpoint, args.model_type, args.repeat)
+    elif args.cpu_modes:
+        if not args.checkpoint:
+            parser.error('--cpu-modes needs --checkpoint')
+        results = bench_cpu_modes(args.checkpoint, args.model_type, args.image, args.cpu_modes,
+                                  args.repeat, args.threads)
+    else:
+        results = run_benchmarks(args.sizes, args.masks, args.repeat, args.only)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,16 @@
 '''
 Script to generate Meta Segment Anything masks.
 
+Besides the SegmentAnythingProcessor used by the GIMP plugin, running this
+file segments batches of images headlessly, e.g.
+
+    seganybridge.py 'shots/*.jpg' --checkpoint sam_vit_b_01ec64.pth \
+        --model-type vit_b --seg-type Box --boxes boxes.json --output-dir masks
+
+The model is loaded once, images are decoded on worker threads ahead of
+inference, and finished images are recorded in the output directory so an
+interrupted run resumes where it stopped. See --help for prompt file formats.
+
 Adapted from:
 https://github.com/facebookresearch/segment-anything/blob/main/notebooks/predictor_example.ipynb
 Original Author: Shrinivas Kulkarni
@@ -28,126 +38,1233 @@ import torch
 import numpy as np
 import cv2
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+import argparse
+import gc
+import glob
+import hashlib
+import json
 import logging
+import os
+import shutil
 import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from seganyformat import pack_array, write_mask, write_array
+from seganyprofile import profiler
+from seganycache import (EmbeddingCache, ResultCache, image_key, DEFAULT_EMBEDDING_CACHE_BYTES,
+                         DEFAULT_RESULT_CACHE_BYTES, RESULT_CACHE_VERSION)
+from seganytask import SegmentationTask, SegmentationCancelled
+from seganyparams import (AUTO_PRESETS, DEFAULT_AUTO_PRESET, AUTO_PARAM_TYPES, auto_generator_params,
+                           DEFAULT_MASK_FILTERS, MASK_FILTER_TYPES, mask_filter_params)
+
+NMS_SIDE = 256  # long side of the mask stack compared in NMS
+
+# Output modes of run_segmentation: one record per mask, or a single record
+# whose 'segmentation' is a uint16 label image (see label_map)
+OUTPUT_MODES = ['masks', 'labels']
+LABEL_ORDERS = ['area', 'score']
+MAX_LABELS = np.iinfo(np.uint16).max
+
+
+# Large image mode for segment_auto. 'downscale' runs the generator on a proxy
+# whose long side is proxy_side and upsamples the masks (optionally refined
+# against the full resolution image with a guided filter); 'tiled' runs it on
+# overlapping tile_size tiles and merges masks that continue across tiles. In
+# both modes at most memory_budget bytes of full resolution masks are kept,
+# highest scores first. Images below min_pixels are processed normally.
+DEFAULT_LARGE_IMAGE_OPTIONS = {
+    'mode': 'off',
+    'min_pixels': 16_000_000,
+    'memory_budget': 2 * 1024 ** 3,
+    'proxy_side': 2048,
+    'refine_edges': False,
+    'tile_size': 2048,
+    'tile_overlap': 256,
+    'merge_iou': 0.6,
+}
+
+
+# CPU inference options, used when SAM is not running on CUDA. 'quantize'
+# converts the image encoder's Linear layers to dynamic int8 (weights are
+# quantized once at load, activations per call); 'bf16' runs the encoder
+# under bfloat16 autocast, which pays off on CPUs with native bf16 support
+# (AVX512-BF16/AMX) and is slower elsewhere. The two are exclusive, with
+# 'quantize' taking precedence. 'threads' and 'interop_threads' size torch's
+# intra-op and inter-op thread pools; 0 keeps torch's default.
+DEFAULT_CPU_OPTIONS = {
+    'quantize': False,
+    'bf16': False,
+    'threads': 0,
+    'interop_threads': 0,
+}
+
+
+def resolve_cpu_options(options=None):
+    resolved = dict(DEFAULT_CPU_OPTIONS)
+    resolved.update({k: v for k, v in (options or {}).items() if k in DEFAULT_CPU_OPTIONS and v is not None})
+    return resolved
+
+
+def configure_threads(options):
+    # Thread pools are per process, so the last processor configured wins
+    if options['threads'] > 0:
+        torch.set_num_threads(int(options['threads']))
+    if options['interop_threads'] > 0 and torch.get_num_interop_threads() != options['interop_threads']:
+        try:
+            torch.set_num_interop_threads(int(options['interop_threads']))
+        except RuntimeError as e:
+            # Only allowed before the first inter-op parallel work in the process
+            logging.warning(f"Could not set inter-op threads: {e}")
+
+
+class AutocastEncoder(torch.nn.Module):
+    # Runs the image encoder under CPU bf16 autocast and hands fp32 features to the decoder
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+        self.img_size = encoder.img_size
+
+    def forward(self, x):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return self.encoder(x).float()
+
+
+def optimize_for_cpu(sam, options):
+    # Apply the CPU options to sam's image encoder; returns the variant name ('fp32', 'int8' or 'bf16')
+    if options['quantize']:
+        if options['bf16']:
+            logging.warning("bf16 autocast is ignored with int8 quantization")
+        with profiler.span('quantize'):
+            sam.image_encoder = torch.ao.quantization.quantize_dynamic(
+                sam.image_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+        return 'int8'
+    if options['bf16']:
+        sam.image_encoder = AutocastEncoder(sam.image_encoder)
+        return 'bf16'
+    return 'fp32'
+
+
+# Inference backends for prompt decoding. 'torch' uses SamPredictor; 'onnx'
+# runs the exported mask decoder with ONNX Runtime and 'onnx-full' the image
+# encoder as well (see seganyonnx.py). Auto mode always uses PyTorch, as
+# SamAutomaticMaskGenerator drives the torch model directly; with 'onnx-full'
+# that model is only loaded (and counted in model_bytes) once Auto mode runs.
+BACKENDS = ['torch', 'onnx', 'onnx-full']
+
+
+class ProgressMaskGenerator(SamAutomaticMaskGenerator):
+    '''
+    SamAutomaticMaskGenerator that reports each crop embedding and decoder
+    batch to a SegmentationTask, so Auto mode shows the masks found so far
+    and stops between batches when the task is cancelled. Fractions are
+    mapped into progress_range so tiled runs advance one bar.
+    '''
+    def __init__(self, model, task=None, progress_range=(0.0, 1.0), **kwargs):
+        super().__init__(model, **kwargs)
+        self.task = task or SegmentationTask()
+        self.progress_range = progress_range
+        self.batches_done = 0
+        self.mask_count = 0
+        self.batches_total = sum(
+            4 ** layer * -(-len(grid) // self.points_per_batch)
+            for layer, grid in enumerate(self.point_grids))
+
+    def fraction(self):
+        low, high = self.progress_range
+        return low + (high - low) * min(1.0, self.batches_done / max(1, self.batches_total))
+
+    def _process_crop(self, image, crop_box, crop_layer_idx, orig_size):
+        self.task.step('embedding', self.fraction())
+        return super()._process_crop(image, crop_box, crop_layer_idx, orig_size)
+
+    def _process_batch(self, points, im_size, crop_box, orig_size):
+        data = super()._process_batch(points, im_size, crop_box, orig_size)
+        self.batches_done += 1
+        self.mask_count += len(data['iou_preds'])
+        self.task.step('decode', self.fraction(), masks=self.mask_count)
+        return data
+
 
 class SegmentAnythingProcessor:
-    def __init__(self, model_type, checkpoint_path):
+    def __init__(self, model_type, checkpoint_path, embedding_cache_bytes=DEFAULT_EMBEDDING_CACHE_BYTES,
+                 embedding_cache_dir=None, cpu_options=None, backend='torch', onnx_dir=None,
+                 mmap_weights=False, weights_dir=None, result_cache_dir=None,
+                 result_cache_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend}")
         self.model_type = model_type
         self.checkpoint_path = checkpoint_path
-        self.sam = sam_model_registry[model_type](checkpoint=checkpoint_path)
+        self.mmap_weights = mmap_weights
+        self.weights_dir = weights_dir
+        self.cpu_options = resolve_cpu_options(cpu_options)
+        configure_threads(self.cpu_options)
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.variant = 'fp32'
+        self.sam = self.predictor = self.backend = None
+        with profiler.span('model_load'):
+            if backend == 'torch':
+                sam = self.build_sam()
+            else:
+                from seganyonnx import OnnxBackend, onnx_exported
+                sam = None
+                if backend == 'onnx' or not onnx_exported(checkpoint_path, onnx_dir):
+                    sam = self.build_sam()
+                # Export (first use only) before the torch model is moved or optimized
+                self.backend = OnnxBackend(sam, checkpoint_path, onnx_dir, encoder=backend == 'onnx-full',
+                                           threads=self.cpu_options['threads'])
+            if backend == 'onnx-full':
+                # ONNX Runtime runs the encoder and decoder. The torch model is only
+                # needed by Auto mode and is loaded by its first run (see torch_model),
+                # rather than keeping a second copy of the image encoder resident.
+                self.variant = 'onnx'
+                del sam
+                logging.info("SAM is running onnx (torch model loaded on the first Auto run)")
+            else:
+                self.load_model(sam)
+        self.embedding_cache = EmbeddingCache(embedding_cache_bytes, embedding_cache_dir)
+        # Auto mode results on disk, only with a result_cache_dir. Requests may
+        # name their own directory (see get_result_cache), so one loaded model
+        # serves clients with different cache settings.
+        self.result_cache = None
+        if result_cache_dir and result_cache_bytes > 0:
+            self.result_cache = ResultCache(result_cache_dir, result_cache_bytes)
+        self.result_caches = {}
+        self.sessions = {}
+
+    def build_sam(self):
+        # The torch SAM as stored in the checkpoint, before it is moved or optimized
+        if self.mmap_weights:
+            # Converted once to safetensors, then memory-mapped (see seganyweights)
+            from seganyweights import load_sam
+            return load_sam(self.model_type, self.checkpoint_path, self.weights_dir)
+        return sam_model_registry[self.model_type](checkpoint=self.checkpoint_path)
+
+    def load_model(self, sam):
+        # Make sam this processor's torch model, on the GPU or optimized for the CPU
         if torch.cuda.is_available():
-            self.sam.to(device='cuda')
+            sam.to(device='cuda')
             logging.info("SAM is running cuda")
+        else:
+            variant = optimize_for_cpu(sam, self.cpu_options)
+            if self.variant != 'onnx':
+                self.variant = variant
+            logging.info(f"SAM is running cpu ({variant}, {torch.get_num_threads()} threads)")
+        self.sam = sam
+        self.predictor = SamPredictor(sam)
+
+    def torch_model(self):
+        # The torch SAM, loaded here on first use with the onnx-full backend
+        if self.sam is None:
+            with profiler.span('model_load'):
+                self.load_model(self.build_sam())
+        return self.sam
+
+    def get_result_cache(self, result_cache_dir=None, result_cache_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        # The ResultCache of a request's result_cache_dir, or the processor's own without one
+        if not result_cache_dir:
+            return self.result_cache
+        if result_cache_bytes <= 0:
+            return None
+        cache = self.result_caches.get(result_cache_dir)
+        if cache is None:
+            cache = self.result_caches[result_cache_dir] = ResultCache(result_cache_dir, result_cache_bytes)
+        cache.max_bytes = result_cache_bytes
+        return cache
+
+    def cache_key(self, cv_image, *extra):
+        # image_key for this model, checkpoint and variant
+        if self.variant != 'fp32':
+            extra = (self.variant,) + extra
+        return image_key(cv_image, self.model_type, os.path.basename(str(self.checkpoint_path)), *extra)
+
+    def get_embedding(self, cv_image):
+        # Image encoder output for cv_image, from the cache when these pixels were seen before
+        key = self.cache_key(cv_image)
+        entry = self.embedding_cache.get(key, device=self.device)
+        if entry is not None:
+            logging.info(f"Using cached image embedding {key}")
+            return entry
+
+        if self.backend is not None and self.backend.encoder is not None:
+            entry = self.backend.encode(cv_image)
+            entry['features'] = torch.from_numpy(entry['features'])
+        else:
+            predictor = self.predictor
+            with profiler.span('embedding'):
+                predictor.set_image(cv_image)
+            entry = {
+                'features': predictor.features,
+                'original_size': tuple(predictor.original_size),
+                'input_size': tuple(predictor.input_size),
+            }
+        self.embedding_cache.put(key, entry)
+        return entry
+
+    def use_embedding(self, entry):
+        # Point the shared predictor at a previously computed embedding
+        predictor = self.predictor
+        if predictor.is_image_set and predictor.features is entry['features']:
+            return predictor
+        predictor.reset_image()
+        predictor.features = entry['features']
+        predictor.original_size = tuple(entry['original_size'])
+        predictor.input_size = tuple(entry['input_size'])
+        predictor.is_image_set = True
+        return predictor
+
+    def get_predictor(self, cv_image):
+        # Return the shared predictor with cv_image set, skipping the image
+        # encoder when the embedding for these pixels is already cached
+        return self.use_embedding(self.get_embedding(cv_image))
+
+    def predict(self, entry, **kwargs):
+        # SamPredictor.predict on an embedding entry, through the configured backend
+        if self.backend is not None:
+            return self.backend.predict(entry, **kwargs)
+        with profiler.span('decode'):
+            return self.use_embedding(entry).predict(**kwargs)
+
+    def start_session(self, ip_file, box_cos=None):
+        # Interactive refinement: returns an id for update_session/undo_session/end_session
+        with profiler.span('image_read'):
+            cv_image = load_image(ip_file)
+        session = RefinementSession(self, self.get_embedding(cv_image), box_cos)
+        self.sessions[session.session_id] = session
+        return session.session_id
+
+    def update_session(self, session_id, points, labels):
+        return self.sessions[session_id].update(points, labels)
+
+    def undo_session(self, session_id):
+        return self.sessions[session_id].undo()
+
+    def end_session(self, session_id):
+        return self.sessions.pop(session_id, None) is not None
+
+    def model_bytes(self):
+        # Memory held by this processor: weights, ONNX models and cached embeddings
+        modules = [] if self.sam is None else list(self.sam.modules())
+        tensors = [] if self.sam is None else list(self.sam.parameters()) + list(self.sam.buffers())
+        nbytes = sum(t.element_size() * t.nelement() for t in tensors)
+        for module in modules:
+            # Dynamic int8 Linear layers keep their weights in packed params, not parameters
+            if hasattr(module, '_packed_params') and hasattr(module._packed_params, '_weight_bias'):
+                weight, bias = module._packed_params._weight_bias()
+                nbytes += weight.element_size() * weight.nelement()
+                if bias is not None:
+                    nbytes += bias.element_size() * bias.nelement()
+        if self.backend is not None:
+            nbytes += self.backend.model_bytes()
+        # Sessions keep their embedding alive after the cache has dropped it
+        with self.embedding_cache.lock:
+            cached = {id(entry) for entry in self.embedding_cache.entries.values()}
+        nbytes += sum(EmbeddingCache.entry_size(session.embedding) for session in self.sessions.values()
+                      if id(session.embedding) not in cached)
+        return nbytes + self.embedding_cache.nbytes
+
+    def release(self):
+        # Drop the model, sessions and cached embeddings (the processor is unusable afterwards)
+        self.sessions.clear()
+        self.embedding_cache.clear()
+        self.predictor = self.sam = self.backend = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
     def pack_bool_array(self, filepath, arr):
-        packed_data = bytearray()
-        num_rows = len(arr)
-        num_cols = len(arr[0])
+        return write_mask(filepath, arr, format_binary=True)
 
-        packed_data.extend([num_rows >> 24, (num_rows >> 16) & 255, (num_rows >> 8) & 255, num_rows & 255])
-        packed_data.extend([num_cols >> 24, (num_cols >> 16) & 255, (num_cols >> 8) & 255, num_cols & 255])
+    def save_mask(self, filepath, mask_arr, format_binary, origin=None):
+        write_mask(filepath, mask_arr, format_binary, origin)
 
-        current_byte = 0
-        bit_position = 0
+    def save_masks(self, masks, save_file_no_ext, format_binary, task=None, image_shape=None):
+        # Cropped records (see crop_record) are saved with their origin, or
+        # back on the full canvas of image_shape in the text format. A
+        # cancelled export removes the files it already wrote.
+        written = []
+        try:
+            for i, mask in enumerate(masks):
+                if task is not None:
+                    task.step('serialization', i / max(1, len(masks)))
+                filepath = save_file_no_ext + str(i) + '.seg'
+                written.append(filepath)
+                self.save_record(filepath, mask, format_binary, image_shape)
+        except SegmentationCancelled:
+            remove_files(written)
+            raise
 
-        for row in arr:
-            for boolean_value in row:
-                if boolean_value:
-                    current_byte |= (1 << bit_position)
-                bit_position += 1
+    def save_record(self, filepath, mask, format_binary, image_shape=None):
+        # One mask (record or array) as a .seg file, see save_masks
+        logging.info(f"Saving mask to: {filepath}")
+        arr, origin = mask, None
+        if isinstance(mask, dict):
+            arr = mask['segmentation']
+            if image_shape is not None and arr.shape != tuple(image_shape[:2]):
+                if format_binary:
+                    origin = mask['bbox'][:2]
+                else:
+                    arr = full_mask(mask, *image_shape[:2])
+        with profiler.span('serialization'):
+            self.save_mask(filepath, arr, format_binary, origin)
 
-                if bit_position == 8:
-                    packed_data.append(current_byte)
-                    current_byte = 0
-                    bit_position = 0
+    def save_labels(self, record, save_file_no_ext):
+        # <prefix>labels.seg holds the uint16 label image, <prefix>labels.json the per-label scores and boxes
+        filepath = save_file_no_ext + 'labels.seg'
+        logging.info(f"Saving label map to: {filepath}")
+        with profiler.span('serialization'):
+            write_array(filepath, record['segmentation'])
+            with open(save_file_no_ext + 'labels.json', 'w') as f:
+                json.dump(record['labels'], f)
 
-        if bit_position > 0:
-            packed_data.append(current_byte)
+    def make_results(self, masks, scores):
+        # Mask records handed back to the caller: bool array, score and XYWH bbox
+        return [{'segmentation': mask, 'score': float(score), 'bbox': mask_bbox(mask)}
+                for mask, score in zip(masks, scores)]
 
-        with open(filepath, 'wb') as f:
-            f.write(packed_data)
+    def generate_auto(self, cv_image, auto_params=None, task=None, progress_range=(0.0, 1.0)):
+        mask_generator = ProgressMaskGenerator(self.torch_model(), task, progress_range, **(auto_params or {}))
+        with profiler.span('auto_generate'):
+            masks = mask_generator.generate(cv_image)
+        # SAM's XYWH boxes are built from inclusive max indices, so w and h are one pixel short
+        return [{'segmentation': mask['segmentation'], 'score': float(mask['predicted_iou']),
+                 'stability_score': float(mask['stability_score']),
+                 'bbox': auto_bbox(mask['bbox'], mask['segmentation'])} for mask in masks]
 
-        return packed_data
+    def segment_auto_cached(self, cv_image, large_image=None, auto_params=None, task=None, result_cache=None):
+        # segment_auto through result_cache (a ResultCache or None). The masks
+        # are cached before mask_filters, so changing the filters still hits.
+        task = task or SegmentationTask()
+        if result_cache is None:
+            return self.segment_auto(cv_image, large_image, auto_params, task)
+        key = self.cache_key(cv_image, 'auto', RESULT_CACHE_VERSION, json.dumps(auto_params, sort_keys=True),
+                             json.dumps(large_image_options(cv_image, large_image), sort_keys=True))
+        with profiler.span('result_cache'):
+            results = result_cache.get(key, cv_image.shape)
+        if results is not None:
+            logging.info(f"Using {len(results)} cached Auto masks {key}")
+            task.step('result_cache', 1.0, masks=len(results))
+            return results
+        results = self.segment_auto(cv_image, large_image, auto_params, task)
+        with profiler.span('result_cache'):
+            result_cache.put(key, results)
+        return results
 
-    def save_mask(self, filepath, mask_arr, format_binary):
-        if format_binary:
-            self.pack_bool_array(filepath, mask_arr)
-        else:
-            with open(filepath, 'w') as f:
-                for row in mask_arr:
-                    f.write(''.join(str(int(val)) for val in row) + '\n')
-
-    def save_masks(self, masks, save_file_no_ext, format_binary):
-        for i, mask in enumerate(masks):
-            filepath = save_file_no_ext + str(i) + '.seg'
-            arr = [[val for val in row] for row in mask]
-            logging.info(f"Saving mask to: {filepath}")
-            self.save_mask(filepath, arr, format_binary)
-
-    def segment_auto(self, cv_image, save_file_no_ext, format_binary):
-        mask_generator = SamAutomaticMaskGenerator(self.sam)
-        masks = mask_generator.generate(cv_image)
-        masks = [mask['segmentation'] for mask in masks]
-        self.save_masks(masks, save_file_no_ext, format_binary)
-
-    def segment_box(self, cv_image, mask_type, box_cos, save_file_no_ext, format_binary):
-        predictor = SamPredictor(self.sam)
-        predictor.set_image(cv_image)
+    def segment_auto(self, cv_image, large_image=None, auto_params=None, task=None):
+        options = large_image_options(cv_image, large_image)
+        if options is None:
+            return self.generate_auto(cv_image, auto_params, task)
+        logging.info(f"Large image mode: {options['mode']}")
+        if options['mode'] == 'downscale':
+            return self.segment_auto_downscaled(cv_image, options, auto_params, task)
+        if options['mode'] == 'tiled':
+            return self.segment_auto_tiled(cv_image, options, auto_params, task)
+        raise ValueError(f"Unknown large image mode: {options['mode']}")
+
+    def segment_auto_downscaled(self, cv_image, options, auto_params=None, task=None):
+        height, width = cv_image.shape[:2]
+        scale = min(1.0, options['proxy_side'] / max(height, width))
+        proxy = cv2.resize(cv_image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+        records = self.generate_auto(proxy, auto_params, task, (0.0, 0.8))
+        del proxy
+        records = limit_to_budget(records, width * height, options['memory_budget'])
+
+        guide = cv2.cvtColor(cv_image, cv2.COLOR_RGB2GRAY) if options['refine_edges'] else None
+        results = []
+        with profiler.span('upsample'):
+            for idx, record in enumerate(records):
+                if task is not None:
+                    task.step('upsample', 0.8 + 0.2 * idx / len(records))
+                mask = upsample_mask(record['segmentation'], width, height, guide)
+                record['segmentation'] = None  # release the proxy mask as we go
+                results.append({'segmentation': mask, 'score': record['score'], 'bbox': mask_bbox(mask),
+                                'stability_score': record.get('stability_score')})
+        return results
+
+    def segment_auto_tiled(self, cv_image, options, auto_params=None, task=None):
+        height, width = cv_image.shape[:2]
+        tile_size = options['tile_size']
+        step = max(1, tile_size - options['tile_overlap'])
+        tiles = [(tx, ty, min(width, tx + tile_size), min(height, ty + tile_size))
+                 for ty in tile_starts(height, tile_size, step)
+                 for tx in tile_starts(width, tile_size, step)]
+        pieces = []
+        for idx, tile in enumerate(tiles):
+            tx, ty = tile[:2]
+            logging.info(f"Segmenting tile {tile}")
+            if task is not None:
+                task.step('tiles', idx / len(tiles), tile=idx + 1, tiles=len(tiles))
+            tile_range = (idx / len(tiles), (idx + 1) / len(tiles))
+            for record in self.generate_auto(cv_image[tile[1]:tile[3], tile[0]:tile[2]], auto_params,
+                                             task, tile_range):
+                x, y, w, h = record['bbox']
+                if w == 0 or h == 0:
+                    continue
+                # Keep only the bbox crop so the tile sized mask can be freed
+                pieces.append({'crop': record['segmentation'][y:y + h, x:x + w].copy(),
+                               'x': tx + x, 'y': ty + y, 'score': record['score'], 'tiles': [tile]})
+        with profiler.span('merge_tiles'):
+            pieces = merge_tile_masks(pieces, options['merge_iou'])
+        pieces = limit_to_budget(pieces, width * height, options['memory_budget'])
+
+        results = []
+        for piece in pieces:
+            mask = np.zeros((height, width), dtype=np.bool_)
+            h, w = piece['crop'].shape
+            mask[piece['y']:piece['y'] + h, piece['x']:piece['x'] + w] = piece['crop']
+            results.append({'segmentation': mask, 'score': piece['score'], 'bbox': (piece['x'], piece['y'], w, h)})
+        return results
+
+    def segment_box(self, cv_image, mask_type, box_cos):
+        entry = self.get_embedding(cv_image)
 
         input_box = np.array(box_cos)
-        masks, _, _ = predictor.predict(
+        masks, scores, _ = self.predict(
+            entry,
             point_coords=None,
             point_labels=None,
             box=input_box,
             multimask_output=(mask_type == 'Multiple'),
         )
-        self.save_masks(masks, save_file_no_ext, format_binary)
-
-    def segment_sel(self, cv_image, mask_type, sel_file, box_cos, save_file_no_ext, format_binary):
-        pts = []
-        with open(sel_file, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                cos = line.split(' ')
-                pts.append([int(cos[0]), int(cos[1])])
-
-        predictor = SamPredictor(self.sam)
-        predictor.set_image(cv_image)
-
-        input_point = np.array(pts)
-        input_label = np.array([1 for i in range(len(input_point))])
-
-        if box_cos is None:
-            masks, scores, logits = predictor.predict(
-                point_coords=input_point,
-                point_labels=input_label,
-                multimask_output=(mask_type == 'Multiple'),
-            )
-        else:
-            input_box = np.array(box_cos)
-            masks, scores, logits = predictor.predict(
-                point_coords=input_point,
-                point_labels=input_label,
-                box=input_box,
-                multimask_output=(mask_type == 'Multiple'),
-            )
-        self.save_masks(masks, save_file_no_ext, format_binary)
-
-    def run_segmentation(self, ip_file, seg_type, mask_type, save_file_no_ext, format_binary, sel_file=None, box_cos=None):
-        cv_image = cv2.imread(ip_file)
-        cv_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
+        return self.make_results(masks, scores)
+
+    def segment_sel(self, cv_image, mask_type, points, box_cos):
+        entry = self.get_embedding(cv_image)
 
+        input_point = np.asarray(points).reshape(-1, 2)
+        input_label = np.ones(len(input_point), dtype=np.int32)
+
+        input_box = None if box_cos is None else np.array(box_cos)
+        masks, scores, logits = self.predict(
+            entry,
+            point_coords=input_point,
+            point_labels=input_label,
+            box=input_box,
+            multimask_output=(mask_type == 'Multiple'),
+        )
+        return self.make_results(masks, scores)
+
+    def segment_boxes(self, cv_image, mask_type, boxes, batch_size=16, task=None):
+        # All boxes against one image embedding. Each record's 'group' is the index of its box.
+        return [record for batch in self.iter_boxes(cv_image, mask_type, boxes, batch_size, task)
+                for record in batch]
+
+    def iter_boxes(self, cv_image, mask_type, boxes, batch_size=16, task=None):
+        # Yields the records of batch_size boxes at a time, decoded together with predict_torch
+        if self.backend is not None:
+            yield from self.iter_boxes_onnx(cv_image, mask_type, boxes, task)
+            return
+        predictor = self.get_predictor(cv_image)
+        count = 0
+        for start in range(0, len(boxes), batch_size):
+            if task is not None:
+                task.step('decode', start / len(boxes), masks=count)
+            batch = torch.as_tensor(np.asarray(boxes[start:start + batch_size], dtype=np.float32),
+                                    device=predictor.device)
+            transformed = predictor.transform.apply_boxes_torch(batch, predictor.original_size)
+            with profiler.span('decode'), torch.no_grad():
+                masks, scores, _ = predictor.predict_torch(
+                    point_coords=None,
+                    point_labels=None,
+                    boxes=transformed,
+                    multimask_output=(mask_type == 'Multiple'),
+                )
+            masks = masks.cpu().numpy()
+            scores = scores.float().cpu().numpy()
+            batch = []
+            for offset in range(len(masks)):
+                for record in self.make_results(masks[offset], scores[offset]):
+                    record['group'] = start + offset
+                    batch.append(record)
+            count += len(batch)
+            yield batch
+
+    def iter_boxes_onnx(self, cv_image, mask_type, boxes, task=None):
+        # The exported decoder takes one prompt set per run, so boxes are decoded one by one
+        entry = self.get_embedding(cv_image)
+        count = 0
+        for idx, box in enumerate(boxes):
+            if task is not None:
+                task.step('decode', idx / len(boxes), masks=count)
+            masks, scores, _ = self.predict(entry, box=np.asarray(box), multimask_output=(mask_type == 'Multiple'))
+            batch = self.make_results(masks, scores)
+            for record in batch:
+                record['group'] = idx
+            count += len(batch)
+            yield batch
+
+    def segment(self, cv_image, seg_type, mask_type, points=None, box_cos=None, large_image=None,
+                auto_preset=None, auto_overrides=None, task=None, mask_filters=None,
+                result_cache_dir=None, result_cache_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        # In-memory entry point: returns a list of dicts with 'segmentation'
+        # (HxW bool array), 'score' and 'bbox' (x, y, w, h). task, a
+        # SegmentationTask, receives progress and can cancel the run;
+        # mask_filters override DEFAULT_MASK_FILTERS. Auto mode results are
+        # cached in result_cache_dir (see get_result_cache).
+        task = task or SegmentationTask()
         if seg_type == 'Auto':
-            logging.info("segment Auto")
-            self.segment_auto(cv_image, save_file_no_ext, format_binary)
+            auto_params = auto_generator_params(auto_preset, auto_overrides)
+            logging.info(f"segment Auto {auto_params}")
+            results = self.segment_auto_cached(cv_image, large_image, auto_params, task,
+                                               self.get_result_cache(result_cache_dir, result_cache_bytes))
         elif seg_type in {'Selection', 'Box-Selection'}:
             logging.info("segment Selection")
-            self.segment_sel(cv_image, mask_type, sel_file, box_cos, save_file_no_ext, format_binary)
+            task.step('embedding')
+            results = self.segment_sel(cv_image, mask_type, points, box_cos)
         elif seg_type == 'Box':
             logging.info("segment Box")
-            self.segment_box(cv_image, mask_type, box_cos, save_file_no_ext, format_binary)
+            task.step('embedding')
+            results = self.segment_box(cv_image, mask_type, box_cos)
+        elif seg_type == 'Multi-Box':
+            logging.info(f"segment {len(box_cos)} boxes")
+            task.step('embedding')
+            results = self.segment_boxes(cv_image, mask_type, box_cos, task=task)
         else:
             raise ValueError(f"Unknown segmentation type: {seg_type}")
+
+        filters = mask_filter_params(mask_filters)
+        if any(filters.values()):
+            task.step('filter')
+            with profiler.span('filter'):
+                count = len(results)
+                results = filter_masks(results, filters)
+            logging.info(f"Mask filter kept {len(results)} of {count} masks")
+        return results
+
+    def run_segmentation(self, ip_file, seg_type, mask_type, save_file_no_ext=None, format_binary=True,
+                         sel_file=None, box_cos=None, points=None, large_image=None,
+                         auto_preset=None, auto_overrides=None, task=None, mask_filters=None,
+                         crop_masks=False, output='masks', label_order='area',
+                         result_cache_dir=None, result_cache_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        # Returns the masks from segment(). ip_file is an image path or an HxWx3
+        # RGB uint8 array (e.g. pixels taken straight from GIMP). When
+        # save_file_no_ext is given the masks are also exported as
+        # <save_file_no_ext><idx>.seg files. With crop_masks each
+        # 'segmentation' is only its bbox region (see crop_record). With
+        # output='labels' a single label map record is returned instead.
+        task = task or SegmentationTask()
+        task.step('image_read')
+        with profiler.span('image_read'):
+            cv_image = load_image(ip_file)
+        if points is None and sel_file is not None:
+            points = read_sel_file(sel_file)
+
+        results = self.segment(cv_image, seg_type, mask_type, points, box_cos, large_image,
+                               auto_preset, auto_overrides, task, mask_filters,
+                               result_cache_dir, result_cache_bytes)
+        task.step('masks', 1.0, masks=len(results))
+        if output == 'labels':
+            with profiler.span('label_map'):
+                record = label_record(results, cv_image.shape[0], cv_image.shape[1], label_order)
+            if save_file_no_ext is not None:
+                self.save_labels(record, save_file_no_ext)
+            logging.info("seganybridge.py is complete!")
+            return [record]
+        if crop_masks:
+            results = [crop_record(record) for record in results]
+        if save_file_no_ext is not None:
+            self.save_masks(results, save_file_no_ext, format_binary, task, cv_image.shape)
+        logging.info("seganybridge.py is complete!")
+        return results
+
+    def iter_segment(self, cv_image, seg_type, mask_type, points=None, box_cos=None, large_image=None,
+                     auto_preset=None, auto_overrides=None, task=None, mask_filters=None,
+                     result_cache_dir=None, result_cache_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        # segment() as a generator. Multi-Box records go out as each batch of
+        # boxes is decoded unless NMS or top_k need all masks first; the other
+        # modes produce every mask at once (SAM's own NMS in Auto mode as well),
+        # so their records are handed out one by one and dropped here.
+        task = task or SegmentationTask()
+        filters = mask_filter_params(mask_filters)
+        if seg_type == 'Multi-Box' and not filters['nms_iou'] and not filters['top_k']:
+            logging.info(f"segment {len(box_cos)} boxes, streaming")
+            task.step('embedding')
+            for batch in self.iter_boxes(cv_image, mask_type, box_cos, task=task):
+                yield from (filter_masks(batch, filters) if any(filters.values()) else batch)
+            return
+        results = self.segment(cv_image, seg_type, mask_type, points, box_cos, large_image,
+                               auto_preset, auto_overrides, task, mask_filters,
+                               result_cache_dir, result_cache_bytes)
+        results.reverse()
+        while results:
+            yield results.pop()
+
+    def iter_segmentation(self, ip_file, seg_type, mask_type, save_file_no_ext=None, format_binary=True,
+                          sel_file=None, box_cos=None, points=None, large_image=None,
+                          auto_preset=None, auto_overrides=None, task=None, mask_filters=None,
+                          crop_masks=False, result_cache_dir=None, result_cache_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        # Streaming run_segmentation (masks output only): yields each record as
+        # soon as it is ready, cropped and exported first when asked, so the
+        # caller can build layers while later masks are still being produced.
+        # A cancelled run removes the mask files it exported.
+        task = task or SegmentationTask()
+        task.step('image_read')
+        with profiler.span('image_read'):
+            cv_image = load_image(ip_file)
+        if points is None and sel_file is not None:
+            points = read_sel_file(sel_file)
+
+        written = []
+        try:
+            records = self.iter_segment(cv_image, seg_type, mask_type, points, box_cos, large_image,
+                                        auto_preset, auto_overrides, task, mask_filters,
+                                        result_cache_dir, result_cache_bytes)
+            for idx, record in enumerate(records):
+                if crop_masks:
+                    record = crop_record(record)
+                if save_file_no_ext is not None:
+                    filepath = save_file_no_ext + str(idx) + '.seg'
+                    written.append(filepath)
+                    self.save_record(filepath, record, format_binary, cv_image.shape)
+                task.step('masks', masks=idx + 1)
+                yield record
+        except SegmentationCancelled:
+            remove_files(written)
+            raise
         logging.info("seganybridge.py is complete!")
-        
+
+
+class RefinementSession:
+    '''
+    Stateful point refinement on one image. The embedding, the accumulated
+    positive/negative points and the low-res logits of the best previous mask
+    are kept between updates; the logits go back to the decoder as mask_input
+    so each update costs one decoder pass.
+    '''
+    def __init__(self, processor, embedding, box_cos=None):
+        self.session_id = uuid.uuid4().hex
+        self.processor = processor
+        self.embedding = embedding
+        self.box = None if box_cos is None else np.asarray(box_cos, dtype=np.float32)
+        self.points = np.zeros((0, 2), dtype=np.float32)
+        self.labels = np.zeros(0, dtype=np.int32)
+        self.history = []  # (points, labels, logits, record) after each update
+
+    def update(self, points, labels):
+        # points/labels are the full prompt set (1 = include, 0 = exclude)
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        self.labels = np.asarray(labels, dtype=np.int32).reshape(-1)
+        if len(self.points) == 0 and self.box is None:
+            raise ValueError("Refinement needs at least one point or a box")
+        logits = self.history[-1][2] if self.history else None
+        # Without previous logits let SAM propose three masks and keep the best one
+        masks, scores, all_logits = self.processor.predict(
+            self.embedding,
+            point_coords=self.points if len(self.points) else None,
+            point_labels=self.labels if len(self.points) else None,
+            box=self.box,
+            mask_input=None if logits is None else logits[None, :, :],
+            multimask_output=logits is None,
+        )
+        best = int(np.argmax(scores))
+        record = self.processor.make_results(masks[best:best + 1], scores[best:best + 1])[0]
+        self.history.append((self.points, self.labels, all_logits[best], record))
+        return record
+
+    def undo(self):
+        # Drop the last update and return the mask before it (None if there is none)
+        if self.history:
+            self.history.pop()
+        if not self.history:
+            self.points = np.zeros((0, 2), dtype=np.float32)
+            self.labels = np.zeros(0, dtype=np.int32)
+            return None
+        self.points, self.labels, _, record = self.history[-1]
+        return record
+
+
+def remove_files(filepaths):
+    for filepath in filepaths:
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+
+def load_image(ip_file):
+    if isinstance(ip_file, np.ndarray):
+        if ip_file.ndim != 3 or ip_file.shape[2] != 3:
+            raise ValueError(f"Expected an HxWx3 RGB image, got shape {ip_file.shape}")
+        return np.ascontiguousarray(ip_file, dtype=np.uint8)
+    cv_image = cv2.imread(ip_file)
+    if cv_image is None:
+        raise FileNotFoundError(f"Could not read image: {ip_file}")
+    return cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
+
+
+def read_sel_file(sel_file):
+    data = np.loadtxt(sel_file, dtype=np.int64, ndmin=2)
+    return data.reshape(-1, 2)
+
+
+def mask_bbox(mask):
+    # XYWH bounding box of the True pixels, (0, 0, 0, 0) for an empty mask
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return (0, 0, 0, 0)
+    cols = np.flatnonzero(mask.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+
+
+def auto_bbox(bbox, mask):
+    # Exact XYWH box from SamAutomaticMaskGenerator's, whose w/h miss the last column/row
+    x, y, w, h = (int(v) for v in bbox)
+    if w == 0 and h == 0 and not mask[y, x]:
+        return (0, 0, 0, 0)
+    return (x, y, min(w + 1, mask.shape[1] - x), min(h + 1, mask.shape[0] - y))
+
+
+def crop_record(record):
+    # The record with 'segmentation' cut down to its bbox. A mask whose shape
+    # is the bbox size is a crop located at the bbox's (x, y).
+    x, y, w, h = record['bbox']
+    mask = record['segmentation']
+    if mask.shape == (h, w):
+        return record
+    return dict(record, segmentation=np.ascontiguousarray(mask[y:y + h, x:x + w]))
+
+
+def full_mask(record, height, width):
+    # Full canvas mask of a record, cropped or not
+    mask = record['segmentation']
+    if mask.shape == (height, width):
+        return mask
+    x, y, w, h = record['bbox']
+    full = np.zeros((height, width), dtype=np.bool_)
+    full[y:y + h, x:x + w] = mask
+    return full
+
+
+def label_map(records, height, width, order='area'):
+    # Resolve mask records (cropped or not) into one uint16 image where pixel
+    # value i is the i-th mask of the painting order and 0 is background.
+    # 'area' paints the largest masks first so smaller ones stay visible on
+    # top of them; 'score' paints the best masks last. Returns the image and
+    # a list of {'label', 'score', 'bbox', 'group'} in label order.
+    if order not in LABEL_ORDERS:
+        raise ValueError(f"Unknown label order: {order}")
+    crops = []
+    for record in records:
+        x, y, w, h = record['bbox'] if record.get('bbox') is not None else mask_bbox(record['segmentation'])
+        mask = record['segmentation']
+        if mask.shape != (h, w):
+            mask = mask[y:y + h, x:x + w]
+        crops.append((mask, (x, y, w, h)))
+    if order == 'area':
+        keys = np.array([-np.count_nonzero(mask) for mask, _ in crops])
+    else:
+        keys = np.array([r['score'] or 0.0 for r in records], dtype=np.float32)
+    painting = np.argsort(keys, kind='stable')
+    if len(painting) > MAX_LABELS:
+        logging.warning(f"Label map keeps the last {MAX_LABELS} of {len(painting)} masks")
+        painting = painting[-MAX_LABELS:]
+
+    labels = np.zeros((height, width), dtype=np.uint16)
+    info = []
+    for label, idx in enumerate(painting, 1):
+        mask, (x, y, w, h) = crops[idx]
+        labels[y:y + h, x:x + w][mask] = label
+        info.append({'label': label, 'score': records[idx]['score'], 'bbox': [x, y, w, h],
+                     'group': records[idx].get('group')})
+    return labels, info
+
+
+def label_record(records, height, width, order='area'):
+    labels, info = label_map(records, height, width, order)
+    return {'segmentation': labels, 'score': None, 'bbox': (0, 0, width, height), 'labels': info}
+
+
+def filter_masks(records, filters, nms_side=NMS_SIDE):
+    # Apply mask_filter_params() filters to mask records; survivors keep their original order
+    if not records:
+        return records
+    scores = np.array([r['score'] for r in records], dtype=np.float32)
+    keep = np.ones(len(records), dtype=np.bool_)
+    if filters['min_score'] > 0:
+        keep &= scores >= filters['min_score']
+    if filters['min_stability'] > 0:
+        stability = np.array([r.get('stability_score') or 1.0 for r in records], dtype=np.float32)
+        keep &= stability >= filters['min_stability']
+    if filters['min_area'] > 0 or filters['max_area'] > 0:
+        areas = np.array([np.count_nonzero(r['segmentation']) for r in records])
+        keep &= areas >= filters['min_area']
+        if filters['max_area'] > 0:
+            keep &= areas <= filters['max_area']
+
+    candidates = np.flatnonzero(keep)
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+    if filters['nms_iou'] > 0 and len(order) > 1:
+        order = mask_nms(records, order, filters['nms_iou'], nms_side)
+    if filters['top_k'] > 0:
+        order = order[:filters['top_k']]
+    return [records[i] for i in np.sort(order)]
+
+
+def mask_iou_matrix(masks, nms_side=NMS_SIDE):
+    # Pairwise IoU of equally sized masks, on a strided copy whose long side is at most nms_side
+    height, width = masks[0].shape
+    step = max(1, -(-max(height, width) // nms_side))
+    stack = np.stack([m[::step, ::step] for m in masks]).reshape(len(masks), -1).astype(np.float32)
+    inter = stack @ stack.T
+    areas = np.diag(inter)
+    union = areas[:, None] + areas[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def mask_nms(records, order, iou_threshold, nms_side=NMS_SIDE):
+    # Greedy NMS over order (indices by descending score); masks only suppress their own group
+    iou = mask_iou_matrix([records[i]['segmentation'] for i in order], nms_side)
+    groups = np.array([-1 if records[i].get('group') is None else records[i]['group'] for i in order])
+    iou[groups[:, None] != groups[None, :]] = 0.0
+    suppressed = np.zeros(len(order), dtype=np.bool_)
+    kept = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        kept.append(i)
+        suppressed |= iou[i] > iou_threshold
+    return order[kept]
+
+
+def large_image_options(cv_image, large_image):
+    # Effective large image options, or None when the image should be processed normally
+    options = dict(DEFAULT_LARGE_IMAGE_OPTIONS, **(large_image or {}))
+    height, width = cv_image.shape[:2]
+    if options['mode'] == 'off' or height * width < options['min_pixels']:
+        return None
+    return options
+
+
+def limit_to_budget(records, mask_bytes, memory_budget):
+    # Highest scoring records whose full resolution bool masks fit in memory_budget
+    keep = max(1, int(memory_budget // mask_bytes))
+    records = sorted(records, key=lambda record: record['score'], reverse=True)
+    if len(records) > keep:
+        logging.warning(f"Keeping the best {keep} of {len(records)} masks to stay within "
+                        f"{memory_budget / 2**20:.0f} MB")
+    return records[:keep]
+
+
+def tile_starts(length, tile_size, step):
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size + 1, step))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+
+def guided_filter(guide, src, radius, eps=1e-3):
+    # Edge preserving smoothing of src following the edges of guide (He et al.)
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    mean_i = cv2.boxFilter(guide, -1, ksize)
+    mean_p = cv2.boxFilter(src, -1, ksize)
+    cov_ip = cv2.boxFilter(guide * src, -1, ksize) - mean_i * mean_p
+    var_i = cv2.boxFilter(guide * guide, -1, ksize) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return cv2.boxFilter(a, -1, ksize) * guide + cv2.boxFilter(b, -1, ksize)
+
+
+def upsample_mask(mask, width, height, guide=None, margin=2):
+    # Resize a proxy mask to width x height, only touching the pixels around its bbox
+    out = np.zeros((height, width), dtype=np.bool_)
+    x, y, w, h = mask_bbox(mask)
+    if w == 0:
+        return out
+    proxy_height, proxy_width = mask.shape
+    sx, sy = width / proxy_width, height / proxy_height
+    px0, py0 = max(0, x - margin), max(0, y - margin)
+    px1, py1 = min(proxy_width, x + w + margin), min(proxy_height, y + h + margin)
+    fx0, fy0 = round(px0 * sx), round(py0 * sy)
+    fx1, fy1 = min(width, round(px1 * sx)), min(height, round(py1 * sy))
+    soft = cv2.resize(mask[py0:py1, px0:px1].astype(np.float32), (fx1 - fx0, fy1 - fy0),
+                      interpolation=cv2.INTER_LINEAR)
+    if guide is not None:
+        region = guide[fy0:fy1, fx0:fx1].astype(np.float32) / 255
+        soft = guided_filter(region, soft, max(2, round(max(sx, sy))))
+    out[fy0:fy1, fx0:fx1] = soft > 0.5
+    return out
+
+
+def _overlap(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    return (x0, y0, x1, y1) if x0 < x1 and y0 < y1 else None
+
+
+def _piece_rect(piece):
+    h, w = piece['crop'].shape
+    return (piece['x'], piece['y'], piece['x'] + w, piece['y'] + h)
+
+
+def _piece_region(piece, region):
+    x0, y0, x1, y1 = region
+    return piece['crop'][y0 - piece['y']:y1 - piece['y'], x0 - piece['x']:x1 - piece['x']]
+
+
+def merge_tile_masks(pieces, merge_iou):
+    # Union masks from different tiles that agree (IoU >= merge_iou) inside the
+    # area where their tiles overlap; they are the same object cut by a tile edge
+    merged = []
+    for piece in sorted(pieces, key=lambda p: p['crop'].size, reverse=True):
+        rect = _piece_rect(piece)
+        target = None
+        for other in merged:
+            common = _overlap(rect, _piece_rect(other))
+            if common is None:
+                continue
+            for tile in other['tiles']:
+                if tile == piece['tiles'][0]:
+                    continue
+                region = _overlap(_overlap(tile, piece['tiles'][0]) or (0, 0, 0, 0), common)
+                if region is None:
+                    continue
+                a, b = _piece_region(piece, region), _piece_region(other, region)
+                union = np.count_nonzero(a | b)
+                if union and np.count_nonzero(a & b) / union >= merge_iou:
+                    target = other
+                    break
+            if target is not None:
+                break
+        if target is None:
+            merged.append(piece)
+            continue
+        other_rect = _piece_rect(target)
+        x0, y0 = min(rect[0], other_rect[0]), min(rect[1], other_rect[1])
+        x1, y1 = max(rect[2], other_rect[2]), max(rect[3], other_rect[3])
+        crop = np.zeros((y1 - y0, x1 - x0), dtype=np.bool_)
+        for part in (target, piece):
+            h, w = part['crop'].shape
+            crop[part['y'] - y0:part['y'] - y0 + h, part['x'] - x0:part['x'] - x0 + w] |= part['crop']
+        target.update(crop=crop, x=x0, y=y0, score=max(target['score'], piece['score']),
+                      tiles=target['tiles'] + piece['tiles'])
+    return merged
+
+
+# Headless batch mode
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.webp'}
+OUTPUT_FORMATS = ['seg', 'seg-text', 'png', 'npz']
+PROGRESS_FILE = '.segany_progress.jsonl'
+
+
+def find_images(inputs):
+    # Image files from directories and glob patterns, sorted and de-duplicated
+    found = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = (os.path.join(item, name) for name in os.listdir(item))
+        else:
+            candidates = glob.glob(item)
+        found.extend(path for path in candidates
+                     if os.path.isfile(path) and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS)
+    return sorted(set(found))
+
+
+def load_prompts(filepath):
+    # JSON object mapping image file name (or stem) to its prompt; "*" applies to all others
+    if not filepath:
+        return {}
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def prompt_for(prompts, image_path):
+    name = os.path.basename(image_path)
+    for key in (image_path, name, os.path.splitext(name)[0], '*'):
+        if key in prompts:
+            return prompts[key]
+    return None
+
+
+def read_progress(output_dir):
+    done = set()
+    try:
+        with open(os.path.join(output_dir, PROGRESS_FILE), 'r') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['image'])
+                except (ValueError, KeyError):
+                    continue  # a line cut short by an interrupted run
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def mark_done(output_dir, image_path, mask_count):
+    with open(os.path.join(output_dir, PROGRESS_FILE), 'a') as f:
+        f.write(json.dumps({'image': os.path.abspath(image_path), 'masks': mask_count}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def output_name(image_path):
+    # <stem>-<hash of the absolute path>: images with the same stem (a/img.jpg and
+    # b/img.jpg, or img.jpg and img.png) get their own outputs, and a name stays the
+    # same across resumed runs whatever else is in the batch
+    digest = hashlib.sha1(os.path.abspath(image_path).encode('utf-8')).hexdigest()[:8]
+    return f"{os.path.splitext(os.path.basename(image_path))[0]}-{digest}"
+
+
+def clear_outputs(output_dir, stem):
+    # Remove what an earlier run wrote for stem, so no masks of that run are left over
+    for filepath in glob.glob(os.path.join(glob.escape(output_dir), glob.escape(stem) + '.*')):
+        os.remove(filepath)
+    mask_dir = os.path.join(output_dir, stem)
+    if os.path.isdir(mask_dir):
+        shutil.rmtree(mask_dir)
+
+
+def write_results(results, output_dir, stem, output_format):
+    # Masks in the chosen format plus <stem>.json with the scores and bboxes
+    if output_format == 'npz':
+        tmppath = os.path.join(output_dir, stem + '.tmp.npz')
+        masks = np.stack([r['segmentation'] for r in results]) if results else np.zeros((0, 0, 0), np.bool_)
+        np.savez_compressed(tmppath, masks=np.frombuffer(pack_array(masks), dtype=np.uint8),
+                            scores=np.array([r['score'] for r in results], dtype=np.float32),
+                            bboxes=np.array([r['bbox'] for r in results], dtype=np.int32).reshape(-1, 4))
+        os.replace(tmppath, os.path.join(output_dir, stem + '.npz'))
+        return
+    mask_dir = os.path.join(output_dir, stem)
+    os.makedirs(mask_dir, exist_ok=True)
+    for idx, result in enumerate(results):
+        if output_format == 'png':
+            cv2.imwrite(os.path.join(mask_dir, f'{idx}.png'), result['segmentation'].astype(np.uint8) * 255)
+        else:
+            write_mask(os.path.join(mask_dir, f'{idx}.seg'), result['segmentation'], output_format == 'seg')
+    with open(os.path.join(output_dir, stem + '.json'), 'w') as f:
+        json.dump([{'score': r['score'], 'bbox': list(r['bbox'])} for r in results], f)
+
+
+def write_label_map(record, output_dir, stem, output_format):
+    # The label image as <stem>.png (16-bit), .npz or .seg plus <stem>.json with the labels
+    labels = record['segmentation']
+    if output_format == 'png':
+        cv2.imwrite(os.path.join(output_dir, stem + '.png'), labels)
+    elif output_format == 'npz':
+        np.savez_compressed(os.path.join(output_dir, stem + '.npz'), labels=labels)
+    else:
+        write_array(os.path.join(output_dir, stem + '.seg'), labels)
+    with open(os.path.join(output_dir, stem + '.json'), 'w') as f:
+        json.dump(record['labels'], f)
+
+
+def prefetch(func, items, workers, depth):
+    # Yield (item, func(item)) in order with up to depth calls running ahead on worker threads
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        items = iter(items)
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.pop(0)
+            next_item = next(items, None)
+            if next_item is not None:
+                pending.append((next_item, pool.submit(func, next_item)))
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+
+def run_batch(args):
+    images = find_images(args.inputs)
+    os.makedirs(args.output_dir, exist_ok=True)
+    done = set() if args.restart else read_progress(args.output_dir)
+    todo = [path for path in images if os.path.abspath(path) not in done]
+    logging.info(f"{len(images)} images, {len(images) - len(todo)} already done, {len(todo)} to segment")
+    if not todo:
+        return 0
+
+    boxes = load_prompts(args.boxes)
+    points = load_prompts(args.points)
+    mask_filters = {name: getattr(args, name) for name in DEFAULT_MASK_FILTERS}
+    processor = SegmentAnythingProcessor(args.model_type, args.checkpoint,
+                                         embedding_cache_dir=args.embedding_cache_dir,
+                                         cpu_options={'quantize': args.quantize, 'bf16': args.bf16,
+                                                      'threads': args.threads,
+                                                      'interop_threads': args.interop_threads},
+                                         backend=args.backend, onnx_dir=args.onnx_dir,
+                                         mmap_weights=args.mmap_weights, weights_dir=args.weights_dir,
+                                         result_cache_dir=args.result_cache_dir,
+                                         result_cache_bytes=int(args.result_cache_mb * 1024 ** 2))
+    failures = 0
+    for idx, (image_path, cv_image, error) in enumerate(prefetch(load_image, todo, args.workers,
+                                                                 args.prefetch), 1):
+        stem = output_name(image_path)
+        try:
+            if error is not None:
+                raise error
+            box_cos = prompt_for(boxes, image_path)
+            sel_points = prompt_for(points, image_path)
+            if args.seg_type in {'Box', 'Box-Selection', 'Multi-Box'} and box_cos is None:
+                raise ValueError("no box prompt")
+            if args.seg_type in {'Selection', 'Box-Selection'} and sel_points is None:
+                raise ValueError("no point prompt")
+            results = processor.segment(cv_image, args.seg_type, args.mask_type, sel_points, box_cos,
+                                        auto_preset=args.auto_preset, mask_filters=mask_filters)
+            clear_outputs(args.output_dir, stem)
+            if args.labels:
+                write_label_map(label_record(results, cv_image.shape[0], cv_image.shape[1], args.label_order),
+                                args.output_dir, stem, args.format)
+            else:
+                write_results(results, args.output_dir, stem, args.format)
+            mark_done(args.output_dir, image_path, len(results))
+            logging.info(f"[{idx}/{len(todo)}] {image_path}: {len(results)} masks")
+        except Exception as e:
+            failures += 1
+            logging.error(f"[{idx}/{len(todo)}] {image_path}: {e}")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Segment batches of images with Segment Anything.',
+        epilog='Outputs are named <stem>-<hash of the image path>. '
+               'Prompt files are JSON objects keyed by image file name, stem or path, with "*" as '
+               'the fallback: --boxes maps to [x1, y1, x2, y2] ([[x1, y1, x2, y2], ...] for '
+               'Multi-Box), --points to [[x, y], ...].')
+    parser.add_argument('inputs', nargs='+', help='Image directories and/or glob patterns')
+    parser.add_argument('--checkpoint', required=True, help='SAM checkpoint path')
+    parser.add_argument('--model-type', default='vit_h', choices=['vit_h', 'vit_l', 'vit_b'])
+    parser.add_argument('--seg-type', default='Auto', choices=['Auto', 'Selection', 'Box-Selection', 'Box', 'Multi-Box'])
+    parser.add_argument('--mask-type', default='Multiple', choices=['Single', 'Multiple'])
+    parser.add_argument('--auto-preset', default=DEFAULT_AUTO_PRESET, choices=list(AUTO_PRESETS))
+    parser.add_argument('--boxes', default=None, help='JSON box prompt file')
+    parser.add_argument('--points', default=None, help='JSON point prompt file')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--format', default='seg', choices=OUTPUT_FORMATS)
+    parser.add_argument('--labels', action='store_true', help='Write one uint16 label map per image')
+    parser.add_argument('--label-order', default='area', choices=LABEL_ORDERS)
+    parser.add_argument('--workers', type=int, default=2, help='Image decode threads')
+    parser.add_argument('--prefetch', type=int, default=4, help='Images decoded ahead of inference')
+    parser.add_argument('--embedding-cache-dir', default=None)
+    parser.add_argument('--restart', action='store_true', help='Ignore recorded progress')
+    parser.add_argument('--quantize', action='store_true', help='CPU: dynamic int8 image encoder')
+    parser.add_argument('--bf16', action='store_true', help='CPU: bfloat16 autocast image encoder')
+    parser.add_argument('--threads', type=int, default=0, help='CPU: intra-op threads (0 = torch default)')
+    parser.add_argument('--interop-threads', type=int, default=0, help='CPU: inter-op threads')
+    for name, value in DEFAULT_MASK_FILTERS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=MASK_FILTER_TYPES[name], default=value,
+                            help='Mask filter (0 = off)')
+    parser.add_argument('--backend', default='torch', choices=BACKENDS, help='Prompt decoding backend')
+    parser.add_argument('--onnx-dir', default=None, help='Exported ONNX models (default: next to the checkpoint)')
+    parser.add_argument('--mmap-weights', action='store_true',
+                        help='Load memory-mapped weights converted once from the checkpoint')
+    parser.add_argument('--weights-dir', default=None, help='Converted weights (default: next to the checkpoint)')
+    parser.add_argument('--result-cache-dir', default=None, help='Cache Auto mode results in this directory')
+    parser.add_argument('--result-cache-mb', type=float, default=DEFAULT_RESULT_CACHE_BYTES / 1024 ** 2,
+                        help='Size limit of --result-cache-dir in MiB')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    return run_batch(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
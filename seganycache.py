@@ -0,0 +1,252 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Caches for Segment Anything intermediate results.
+
+EmbeddingCache keeps the image encoder output of SamPredictor.set_image so
+that repeated prompts on the same image only pay for the mask decoder.
+ResultCache keeps the masks of Auto mode runs on disk so running Auto again
+on the same image and settings skips mask generation altogether.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+DEFAULT_EMBEDDING_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_EMBEDDING_DISK_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_RESULT_CACHE_BYTES = 1024 * 1024 * 1024
+RESULT_CACHE_VERSION = 1  # part of every result key; bump when the stored masks change
+
+
+def image_key(cv_image, *extra):
+    # Content hash of the pixel data, shape and dtype plus anything that changes the result
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((cv_image.shape, str(cv_image.dtype)) + extra).encode('utf-8'))
+    h.update(memoryview(cv_image).cast('B') if cv_image.flags['C_CONTIGUOUS'] else cv_image.tobytes())
+    return h.hexdigest()
+
+
+def trim_files(cache_dir, suffix, max_bytes):
+    # Remove the least recently used (oldest mtime) files until the rest fit in max_bytes
+    files = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(suffix):
+            filepath = os.path.join(cache_dir, name)
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, filepath))
+    total = sum(f[1] for f in files)
+    for _, size, filepath in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(filepath)
+            total -= size
+        except OSError:
+            pass
+
+
+class EmbeddingCache:
+    '''
+    In-memory LRU of image embeddings bounded by max_bytes. Entries pushed
+    out of memory are spilled to cache_dir (if set), which is itself trimmed
+    to disk_max_bytes by file modification time.
+    '''
+    def __init__(self, max_bytes=DEFAULT_EMBEDDING_CACHE_BYTES, cache_dir=None,
+                 disk_max_bytes=DEFAULT_EMBEDDING_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def entry_size(entry):
+        features = entry['features']
+        return features.element_size() * features.nelement()
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.emb')
+
+    def get(self, key, device=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        entry = self.load(key, device)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is not None:
+            self.put(key, entry, spill=False)
+        return entry
+
+    def put(self, key, entry, spill=True):
+        size = self.entry_size(entry)
+        if size > self.max_bytes:
+            if spill:
+                self.store(key, entry)
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = entry
+            self.nbytes += size
+            evicted = []
+            while self.nbytes > self.max_bytes:
+                old_key, old_entry = self.entries.popitem(last=False)
+                self.nbytes -= self.entry_size(old_entry)
+                evicted.append((old_key, old_entry))
+        for old_key, old_entry in evicted:
+            logging.debug(f"Evicting embedding {old_key}")
+            self.store(old_key, old_entry)
+
+    def load(self, key, device=None):
+        if not self.cache_dir:
+            return None
+        filepath = self.disk_path(key)
+        try:
+            entry = torch.load(filepath, map_location=device or 'cpu')
+            os.utime(filepath)
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Discarding unreadable embedding {filepath}: {e}")
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+            return None
+
+    def store(self, key, entry):
+        if not self.cache_dir:
+            return
+        filepath = self.disk_path(key)
+        if os.path.exists(filepath):
+            return
+        tmppath = filepath + f'.{os.getpid()}.tmp'
+        cpu_entry = dict(entry, features=entry['features'].detach().cpu())
+        try:
+            torch.save(cpu_entry, tmppath)
+            os.replace(tmppath, filepath)
+        except OSError as e:
+            logging.warning(f"Could not spill embedding to {filepath}: {e}")
+            return
+        self.trim_disk()
+
+    def trim_disk(self):
+        trim_files(self.cache_dir, '.emb', self.disk_max_bytes)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+class ResultCache:
+    '''
+    Disk LRU of Auto mode results bounded by max_bytes, one compressed .npz
+    per key (see image_key) holding every mask's bit packed bbox crop, bbox,
+    score and stability score. A hit touches the file's modification time,
+    which is the eviction order.
+    '''
+    def __init__(self, cache_dir, max_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key, shape):
+        # Mask records with full shape[:2] masks, or None on a miss
+        filepath = self.path(key)
+        try:
+            with np.load(filepath) as data:
+                bits, offsets = data['bits'], data['offsets']
+                bboxes, scores, stability = data['bboxes'], data['scores'], data['stability']
+            os.utime(filepath)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logging.warning(f"Discarding unreadable result cache entry {filepath}: {e}")
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+            self.misses += 1
+            return None
+
+        records = []
+        for idx, (x, y, w, h) in enumerate(bboxes.tolist()):
+            mask = np.zeros(shape[:2], dtype=np.bool_)
+            crop = np.unpackbits(bits[offsets[idx]:offsets[idx + 1]], count=w * h)
+            mask[y:y + h, x:x + w] = crop.reshape(h, w).view(np.bool_)
+            record = {'segmentation': mask, 'score': float(scores[idx]), 'bbox': (x, y, w, h)}
+            if not np.isnan(stability[idx]):
+                record['stability_score'] = float(stability[idx])
+            records.append(record)
+        self.hits += 1
+        return records
+
+    def put(self, key, records):
+        packed = []
+        for record in records:
+            x, y, w, h = (int(v) for v in record['bbox'])
+            packed.append(np.packbits(record['segmentation'][y:y + h, x:x + w], axis=None))
+        filepath = self.path(key)
+        tmppath = filepath + f'.{os.getpid()}.tmp'
+        try:
+            with open(tmppath, 'wb') as f:
+                np.savez_compressed(
+                    f,
+                    bits=np.concatenate(packed) if packed else np.zeros(0, dtype=np.uint8),
+                    offsets=np.cumsum([0] + [len(bits) for bits in packed], dtype=np.int64),
+                    bboxes=np.array([record['bbox'] for record in records], dtype=np.int64).reshape(-1, 4),
+                    scores=np.array([record['score'] for record in records], dtype=np.float64),
+                    stability=np.array([record.get('stability_score', np.nan) for record in records],
+                                       dtype=np.float64))
+            os.replace(tmppath, filepath)
+        except OSError as e:
+            logging.warning(f"Could not write result cache entry {filepath}: {e}")
+            return
+        trim_files(self.cache_dir, '.npz', self.max_bytes)
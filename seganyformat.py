@@ -0,0 +1,142 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Reading and writing of the .seg mask files exchanged between seganybridge.py
+and the GIMP plugin.
+
+Version 1 files start with a header describing the array:
+
+    magic     4 bytes   b'SEGM'
+    version   uint8     1
+    bitorder  uint8     0 = little (LSB first), 1 = big, 255 = not bit packed
+    dtype     8 bytes   numpy dtype string, NUL padded (e.g. '|b1', '<u2')
+    ndim      uint8
+    shape     ndim x uint32
+
+all big-endian, followed by the data. Version 2 adds the array's origin
+(x, y as uint32) after the shape, for masks cropped to their bounding box;
+full canvas masks are still written as version 1. Boolean arrays are bit packed in C
+order; other dtypes are stored as raw bytes. Files without the magic are the
+legacy format: big-endian uint32 rows and cols followed by LSB-first packed
+bits. This module only needs numpy so the plugin can import it cheaply.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import struct
+
+import numpy as np
+
+SEG_MAGIC = b'SEGM'
+SEG_VERSION = 2
+BITORDER_LITTLE = 0
+BITORDER_BIG = 1
+BITORDER_NONE = 255
+
+_HEADER = struct.Struct('>4sBB8sB')
+_LEGACY_HEADER = struct.Struct('>II')
+_ORIGIN = struct.Struct('>II')
+_BITORDERS = {BITORDER_LITTLE: 'little', BITORDER_BIG: 'big'}
+
+
+def pack_array(arr, bitorder='little', origin=None):
+    # origin: (x, y) of a cropped mask within the image
+    arr = np.asarray(arr)
+    if arr.dtype == np.bool_:
+        bitorder_code = BITORDER_LITTLE if bitorder == 'little' else BITORDER_BIG
+        payload = np.packbits(arr, axis=None, bitorder=bitorder)
+    else:
+        bitorder_code = BITORDER_NONE
+        payload = np.ascontiguousarray(arr)
+    header = _HEADER.pack(SEG_MAGIC, 1 if origin is None else 2, bitorder_code,
+                          arr.dtype.str.encode('ascii'), arr.ndim)
+    header += struct.pack(f'>{arr.ndim}I', *arr.shape)
+    if origin is not None:
+        header += _ORIGIN.pack(*origin)
+    return header + payload.tobytes()
+
+
+def unpack_array(data, with_origin=False):
+    # Returns the array, or (array, origin) with with_origin; origin is None for full canvas masks
+    view = memoryview(data)
+    origin = None
+    if bytes(view[:4]) != SEG_MAGIC:
+        num_rows, num_cols = _LEGACY_HEADER.unpack_from(view)
+        bits = np.frombuffer(view, dtype=np.uint8, offset=_LEGACY_HEADER.size)
+        count = num_rows * num_cols
+        arr = np.unpackbits(bits, count=count, bitorder='little').view(np.bool_).reshape(num_rows, num_cols)
+        return (arr, origin) if with_origin else arr
+
+    _, version, bitorder_code, dtype_str, ndim = _HEADER.unpack_from(view)
+    if version > SEG_VERSION:
+        raise ValueError(f"Unsupported .seg version {version}")
+    offset = _HEADER.size
+    shape = struct.unpack_from(f'>{ndim}I', view, offset)
+    offset += 4 * ndim
+    if version >= 2:
+        origin = _ORIGIN.unpack_from(view, offset)
+        offset += _ORIGIN.size
+    dtype = np.dtype(dtype_str.rstrip(b'\0').decode('ascii'))
+    count = int(np.prod(shape, dtype=np.int64))
+    if bitorder_code == BITORDER_NONE:
+        arr = np.frombuffer(view, dtype=dtype, count=count, offset=offset).reshape(shape)
+    else:
+        bits = np.frombuffer(view, dtype=np.uint8, offset=offset)
+        arr = np.unpackbits(bits, count=count, bitorder=_BITORDERS[bitorder_code]).view(np.bool_).reshape(shape)
+    return (arr, origin) if with_origin else arr
+
+
+def write_mask(filepath, arr, format_binary=True, origin=None):
+    # The text format has no origin, so cropped masks must be written in binary
+    arr = np.asarray(arr)
+    if format_binary:
+        data = pack_array(arr.astype(np.bool_, copy=False), origin=origin)
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        return data
+    # Text format, one line of 0/1 characters per row (only for testing)
+    rows = arr.astype(np.uint8) + ord('0')
+    rows = np.concatenate([rows, np.full((rows.shape[0], 1), ord('\n'), np.uint8)], axis=1)
+    data = rows.tobytes()
+    with open(filepath, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def write_array(filepath, arr, origin=None):
+    # Any dtype in the binary format, e.g. uint16 label maps
+    data = pack_array(arr, origin=origin)
+    with open(filepath, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def read_mask(filepath, format_binary=True, with_origin=False):
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    if format_binary:
+        return unpack_array(data, with_origin)
+    lines = data.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    if not lines:
+        arr = np.zeros((0, 0), dtype=np.bool_)
+        return (arr, None) if with_origin else arr
+    rows = np.frombuffer(b''.join(line.strip() for line in lines), dtype=np.uint8)
+    arr = (rows == ord('1')).reshape(len(lines), -1)
+    return (arr, None) if with_origin else arr
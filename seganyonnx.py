@@ -0,0 +1,206 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+ONNX Runtime inference backend for SegmentAnythingProcessor.
+
+The SAM prompt decoder (and optionally the image encoder) is exported to
+ONNX once per checkpoint, next to it in an 'onnx' directory unless another
+directory is given, and then run with onnxruntime on the CPU. predict()
+takes the same arguments and returns the same arrays as
+SamPredictor.predict, so the processor can use either. The decoder export
+follows segment_anything's scripts/export_onnx_model.py; exporting needs
+torch (and onnx for the encoder), running the exported models only needs
+onnxruntime and numpy. The encoder's weights are kept in one
+<encoder>.onnx.data file beside it, as vit_h's exceed the 2 GB limit of a
+single ONNX file.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import inspect
+import logging
+import os
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+from seganyprofile import profiler
+
+ONNX_OPSET = 17
+ENCODER_SIZE = 1024
+MASK_THRESHOLD = 0.0
+PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+
+
+def onnx_paths(checkpoint_path, onnx_dir=None):
+    stem = os.path.splitext(os.path.basename(str(checkpoint_path)))[0]
+    onnx_dir = onnx_dir or os.path.join(os.path.dirname(os.path.abspath(str(checkpoint_path))), 'onnx')
+    return (os.path.join(onnx_dir, stem + '_encoder.onnx'),
+            os.path.join(onnx_dir, stem + '_decoder.onnx'))
+
+
+def external_data_path(filepath):
+    # The single weights file of a model exported with external_data
+    return filepath + '.data'
+
+
+def onnx_exported(checkpoint_path, onnx_dir=None):
+    # Both models are exported, so the torch model is not needed to build an OnnxBackend
+    return all(os.path.exists(path) for path in onnx_paths(checkpoint_path, onnx_dir))
+
+
+def export_decoder(sam, filepath, opset=ONNX_OPSET):
+    import torch
+    from segment_anything.utils.onnx import SamOnnxModel
+
+    # All four mask tokens are returned; predict() picks them like SamPredictor
+    onnx_model = SamOnnxModel(sam, return_single_mask=False)
+    embed_dim = sam.prompt_encoder.embed_dim
+    embed_size = sam.prompt_encoder.image_embedding_size
+    dummy_inputs = {
+        'image_embeddings': torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+        'point_coords': torch.randint(low=0, high=ENCODER_SIZE, size=(1, 5, 2), dtype=torch.float),
+        'point_labels': torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        'mask_input': torch.randn(1, 1, *[4 * x for x in embed_size], dtype=torch.float),
+        'has_mask_input': torch.tensor([1], dtype=torch.float),
+        'orig_im_size': torch.tensor([1500, 2250], dtype=torch.float),
+    }
+    write_onnx(onnx_model, dummy_inputs, ['masks', 'iou_predictions', 'low_res_masks'], filepath, opset,
+               {'point_coords': {1: 'num_points'}, 'point_labels': {1: 'num_points'}})
+
+
+def export_encoder(sam, filepath, opset=ONNX_OPSET):
+    import torch
+    dummy_inputs = {'image': torch.randn(1, 3, ENCODER_SIZE, ENCODER_SIZE, dtype=torch.float)}
+    # vit_h's encoder is over the 2 GB protobuf limit, so every encoder keeps its weights apart
+    write_onnx(sam.image_encoder, dummy_inputs, ['image_embeddings'], filepath, opset, external_data=True)
+
+
+def write_onnx(model, dummy_inputs, output_names, filepath, opset, dynamic_axes=None, external_data=False):
+    # Exported into a temporary directory, then moved into place with the model
+    # file last, so an interrupted export is never mistaken for a finished one.
+    # With external_data the weights go to one external_data_path(filepath)
+    # file rather than the per-tensor files torch writes for large models.
+    import torch
+    onnx_dir = os.path.dirname(os.path.abspath(filepath))
+    os.makedirs(onnx_dir, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix='.export-', dir=onnx_dir)
+    tmppath = os.path.join(tmpdir, os.path.basename(filepath))
+    # The TorchScript exporter, which dynamic_axes is written for (newer torch defaults to dynamo)
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    logging.info(f"Exporting {filepath}")
+    try:
+        with profiler.span('onnx_export'), torch.no_grad():
+            torch.onnx.export(model, tuple(dummy_inputs.values()), tmppath, export_params=True,
+                              opset_version=opset, do_constant_folding=True,
+                              input_names=list(dummy_inputs), output_names=output_names,
+                              dynamic_axes=dynamic_axes, **options)
+            if external_data:
+                import onnx
+                onnx_model = onnx.load(tmppath)
+                data_name = os.path.basename(external_data_path(filepath))
+                onnx.save_model(onnx_model, tmppath, save_as_external_data=True, all_tensors_to_one_file=True,
+                                location=data_name, size_threshold=0)
+                del onnx_model
+                os.replace(os.path.join(tmpdir, data_name), external_data_path(filepath))
+        os.replace(tmppath, filepath)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def preprocess(cv_image):
+    # SAM's encoder input: long side resized to 1024, normalized, padded to 1024x1024, NCHW
+    height, width = cv_image.shape[:2]
+    scale = ENCODER_SIZE / max(height, width)
+    new_h, new_w = int(height * scale + 0.5), int(width * scale + 0.5)
+    resized = cv2.resize(cv_image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    padded = np.zeros((ENCODER_SIZE, ENCODER_SIZE, 3), dtype=np.float32)
+    padded[:new_h, :new_w] = (resized.astype(np.float32) - PIXEL_MEAN) / PIXEL_STD
+    return padded.transpose(2, 0, 1)[None], (height, width), (new_h, new_w)
+
+
+class OnnxBackend:
+    def __init__(self, sam, checkpoint_path, onnx_dir=None, encoder=False, threads=0):
+        # sam is only needed when a model still has to be exported
+        self.encoder_path, self.decoder_path = onnx_paths(checkpoint_path, onnx_dir)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = int(threads)
+        providers = ['CPUExecutionProvider']
+
+        if not os.path.exists(self.decoder_path):
+            export_decoder(sam, self.decoder_path)
+        self.decoder = ort.InferenceSession(self.decoder_path, options, providers=providers)
+        self.encoder = None
+        if encoder:
+            if not os.path.exists(self.encoder_path):
+                export_encoder(sam, self.encoder_path)
+            self.encoder = ort.InferenceSession(self.encoder_path, options, providers=providers)
+        logging.info(f"ONNX Runtime backend: decoder {self.decoder_path}"
+                     + (f", encoder {self.encoder_path}" if encoder else ""))
+
+    def model_bytes(self):
+        # Approximated by the size of the loaded model files, external weights included
+        paths = [self.decoder_path] + ([self.encoder_path] if self.encoder is not None else [])
+        paths += [external_data_path(path) for path in paths]
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def encode(self, cv_image):
+        # Same fields as the embedding entries of SegmentAnythingProcessor, features as numpy
+        image, original_size, input_size = preprocess(cv_image)
+        with profiler.span('embedding'):
+            features = self.encoder.run(None, {'image': image})[0]
+        return {'features': features, 'original_size': original_size, 'input_size': input_size}
+
+    def predict(self, entry, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True):
+        # Mirrors SamPredictor.predict: (masks CxHxW bool, scores C, low-res logits Cx256x256)
+        original_size = entry['original_size']
+        scale = np.array([entry['input_size'][1] / original_size[1],
+                          entry['input_size'][0] / original_size[0]], dtype=np.float32)
+        coords = [] if point_coords is None else [np.asarray(point_coords, dtype=np.float32).reshape(-1, 2)]
+        labels = [] if point_labels is None else [np.asarray(point_labels, dtype=np.float32).reshape(-1)]
+        if box is not None:
+            coords.append(np.asarray(box, dtype=np.float32).reshape(2, 2))
+            labels.append(np.array([2, 3], dtype=np.float32))
+        else:
+            # Padding point, as SamPromptEncoder adds when there is no box
+            coords.append(np.zeros((1, 2), dtype=np.float32))
+            labels.append(np.array([-1], dtype=np.float32))
+
+        features = entry['features']
+        if not isinstance(features, np.ndarray):
+            features = features.detach().cpu().numpy()
+        inputs = {
+            'image_embeddings': features.astype(np.float32, copy=False),
+            'point_coords': (np.concatenate(coords) * scale)[None],
+            'point_labels': np.concatenate(labels)[None],
+            'mask_input': np.zeros((1, 1, 256, 256), dtype=np.float32) if mask_input is None
+            else np.asarray(mask_input, dtype=np.float32).reshape(1, 1, 256, 256),
+            'has_mask_input': np.array([0 if mask_input is None else 1], dtype=np.float32),
+            'orig_im_size': np.array(original_size, dtype=np.float32),
+        }
+        with profiler.span('decode'):
+            masks, scores, low_res = self.decoder.run(None, inputs)
+        chosen = slice(1, None) if multimask_output else slice(0, 1)
+        return masks[0, chosen] > MASK_THRESHOLD, scores[0, chosen], low_res[0, chosen]
@@ -0,0 +1,118 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Auto mode presets and mask filter settings shared by the plugin and
+seganybridge.py.
+
+Kept free of numpy, torch, cv2 and segment_anything: segany.py builds its
+dialog from these tables, and GIMP imports segany.py at every startup to
+query its procedures, long before (and often without) any segmentation.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+# SamAutomaticMaskGenerator settings for Auto mode. 'balanced' is the
+# segment_anything default; 'draft' samples a 12x12 point grid (7x fewer
+# decoder prompts) with looser thresholds; 'full' adds one crop layer and
+# removes small islands and holes.
+AUTO_PRESETS = {
+    'draft': {
+        'points_per_side': 12,
+        'points_per_batch': 144,
+        'pred_iou_thresh': 0.86,
+        'stability_score_thresh': 0.92,
+        'stability_score_offset': 1.0,
+        'crop_n_layers': 0,
+        'min_mask_region_area': 0,
+    },
+    'balanced': {
+        'points_per_side': 32,
+        'points_per_batch': 64,
+        'pred_iou_thresh': 0.88,
+        'stability_score_thresh': 0.95,
+        'stability_score_offset': 1.0,
+        'crop_n_layers': 0,
+        'min_mask_region_area': 0,
+    },
+    'full': {
+        'points_per_side': 32,
+        'points_per_batch': 64,
+        'pred_iou_thresh': 0.88,
+        'stability_score_thresh': 0.95,
+        'stability_score_offset': 1.0,
+        'crop_n_layers': 1,
+        'crop_n_points_downscale_factor': 2,
+        'min_mask_region_area': 100,
+    },
+}
+DEFAULT_AUTO_PRESET = 'balanced'
+AUTO_PARAM_TYPES = {
+    'points_per_side': int,
+    'points_per_batch': int,
+    'pred_iou_thresh': float,
+    'stability_score_thresh': float,
+    'stability_score_offset': float,
+    'crop_n_layers': int,
+    'crop_n_points_downscale_factor': int,
+    'min_mask_region_area': int,
+}
+
+
+def auto_generator_params(preset=None, overrides=None):
+    # Preset settings with overrides applied; unknown keys and None values are ignored
+    preset = (preset or DEFAULT_AUTO_PRESET).lower()
+    if preset not in AUTO_PRESETS:
+        raise ValueError(f"Unknown auto preset: {preset}")
+    params = dict(AUTO_PRESETS[preset])
+    for name, value in (overrides or {}).items():
+        if name in AUTO_PARAM_TYPES and value is not None and value != '':
+            params[name] = AUTO_PARAM_TYPES[name](value)
+    return params
+
+
+# Post-filter applied to the masks of every mode before they are exported or
+# turned into layers. Masks scoring below min_score (predicted IoU) or
+# min_stability (Auto mode only), or whose area in pixels is outside
+# [min_area, max_area], are dropped. nms_iou removes masks overlapping a
+# higher scoring mask of the same group by more than that IoU, and top_k
+# keeps the k best. 0 disables a setting; all are off by default.
+DEFAULT_MASK_FILTERS = {
+    'min_score': 0.0,
+    'min_stability': 0.0,
+    'min_area': 0,
+    'max_area': 0,
+    'nms_iou': 0.0,
+    'top_k': 0,
+}
+MASK_FILTER_TYPES = {
+    'min_score': float,
+    'min_stability': float,
+    'min_area': int,
+    'max_area': int,
+    'nms_iou': float,
+    'top_k': int,
+}
+
+
+def mask_filter_params(overrides=None):
+    # DEFAULT_MASK_FILTERS with overrides applied; unknown keys and empty values are ignored
+    params = dict(DEFAULT_MASK_FILTERS)
+    for name, value in (overrides or {}).items():
+        if name in MASK_FILTER_TYPES and value is not None and value != '':
+            params[name] = MASK_FILTER_TYPES[name](value)
+    return params
@@ -0,0 +1,140 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Thread pipeline that overlaps mask generation with layer creation.
+
+A Pipeline pulls items from a source iterable on one thread (e.g. the mask
+records of SegmentAnythingProcessor.iter_segmentation, arriving from the
+model server), passes each through the stage functions, one thread per
+stage (e.g. rendering a mask into layer pixels), and hands the results to
+the thread iterating the pipeline (GIMP's main thread, which inserts the
+layers). The threads are connected by queues of at most depth items, so
+peak memory is bounded by the queue depth rather than the mask count, and
+the wall time approaches that of the slowest stage. Items keep their order.
+
+An exception on any thread is raised in the consumer. Iteration stops when
+the task (a SegmentationTask) is cancelled or the pipeline is closed.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import queue
+import threading
+
+DEFAULT_QUEUE_DEPTH = 4
+POLL_INTERVAL = 0.05  # seconds between stop checks (and idle calls) while blocked
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Pipeline:
+    def __init__(self, source, stages=(), depth=DEFAULT_QUEUE_DEPTH, task=None, idle=None):
+        # idle() is called on the consumer's thread while it waits for the next item
+        self.task = task
+        self.idle = idle
+        self.stopped = threading.Event()
+        self.queues = [queue.Queue(maxsize=max(1, depth)) for _ in range(len(stages) + 1)]
+        self.threads = [threading.Thread(target=self.produce, args=(source, self.queues[0]),
+                                         name='segany-source', daemon=True)]
+        for idx, stage in enumerate(stages):
+            self.threads.append(threading.Thread(target=self.transform,
+                                                 args=(stage, self.queues[idx], self.queues[idx + 1]),
+                                                 name=f'segany-stage-{idx}', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stopping(self):
+        return self.stopped.is_set() or (self.task is not None and self.task.cancelled.is_set())
+
+    def put(self, out, item):
+        # Blocks while out is full; False once the pipeline is stopping
+        while not self.stopping():
+            try:
+                out.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, inp):
+        while not self.stopping():
+            try:
+                return inp.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def produce(self, source, out):
+        iterator = iter(source)
+        try:
+            for item in iterator:
+                if not self.put(out, item):
+                    break
+            else:
+                self.put(out, _DONE)
+        except BaseException as e:
+            self.put(out, _Failure(e))
+        finally:
+            # A generator source is closed on its own thread
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def transform(self, stage, inp, out):
+        while True:
+            item = self.get(inp)
+            if item is _DONE or isinstance(item, _Failure):
+                self.put(out, item)
+                return
+            try:
+                item = stage(item)
+            except BaseException as e:
+                self.put(out, _Failure(e))
+                return
+            if not self.put(out, item):
+                return
+
+    def __iter__(self):
+        out = self.queues[-1]
+        while True:
+            try:
+                item = out.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.idle is not None:
+                    self.idle()
+                if self.task is not None:
+                    self.task.check()
+                if self.stopped.is_set():
+                    return
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def close(self):
+        # Stop all threads; a source blocked in its own next() finishes that item first
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(POLL_INTERVAL)
@@ -0,0 +1,191 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Opt-in timing instrumentation for the plugin and the SAM bridge.
+
+Code is wrapped in named spans:
+
+    with profiler.span('embedding'):
+        predictor.set_image(cv_image)
+
+When the profiler is not started span() returns a shared no-op context
+manager, so the instrumentation costs one attribute check per span. Started
+in 'spans' mode it records the wall time of each span; 'sampling' mode also
+samples the Python stack of every thread at a fixed interval. The per-stage
+report is written as JSON.
+
+The SEGANY_PROFILE environment variable ('spans' or 'sampling') starts it
+when the module is imported, for profiling scripts that use the bridge
+directly.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_MODES = ['off', 'spans', 'sampling']
+DEFAULT_SAMPLE_INTERVAL = 0.005  # seconds
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.mode = 'off'
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.samples = Counter()
+        self.sample_count = 0
+        self.sampler = None
+        self.sampling = False
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name, start, duration):
+        with self.lock:
+            self.spans.append({
+                'name': name,
+                'start': start - self.origin,
+                'duration': duration,
+                'thread': threading.current_thread().name,
+                'process': os.getpid(),
+            })
+
+    def start(self, mode='spans', interval=DEFAULT_SAMPLE_INTERVAL):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.reset()
+        self.mode = mode
+        self.enabled = mode != 'off'
+        if mode == 'sampling':
+            self.sampling = True
+            self.sampler = threading.Thread(target=self.sample_loop, args=(interval,),
+                                            name='segany-sampler', daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        self.enabled = False
+        self.sampling = False
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+        return self.report()
+
+    def reset(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.spans = []
+            self.samples = Counter()
+            self.sample_count = 0
+
+    def sample_loop(self, interval):
+        # Samples every thread but this one: the work runs on worker and pipeline
+        # threads, not on the thread that started the profiler. Each stack starts
+        # with its thread's name.
+        own_id = threading.get_ident()
+        while self.sampling:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.samples.update(stacks)
+                self.sample_count += 1
+            time.sleep(interval)
+
+    def merge(self, report):
+        # Add the spans of a report produced by another process (the model server)
+        if not report:
+            return
+        with self.lock:
+            for item in report.get('spans', []):
+                self.spans.append(dict(item, start=None))
+            self.samples.update(report.get('samples', {}))
+            self.sample_count += report.get('sample_count', 0)
+
+    def report(self):
+        with self.lock:
+            spans = list(self.spans)
+            samples = dict(self.samples.most_common(200))
+            sample_count = self.sample_count
+        stages = {}
+        for item in spans:
+            stage = stages.setdefault(item['name'], {'count': 0, 'total': 0.0, 'max': 0.0})
+            stage['count'] += 1
+            stage['total'] += item['duration']
+            stage['max'] = max(stage['max'], item['duration'])
+        for stage in stages.values():
+            stage['mean'] = stage['total'] / stage['count']
+        return {
+            'mode': self.mode,
+            'stages': stages,
+            'spans': spans,
+            'samples': samples,
+            'sample_count': sample_count,
+        }
+
+    def write_report(self, filepath, report=None):
+        report = report or self.report()
+        try:
+            with open(filepath, 'w') as f:
+                json.dump(report, f, indent=2)
+            logging.info(f"Profile report written to {filepath}")
+        except OSError as e:
+            logging.error(f"Error writing profile report {filepath}: {e}")
+
+
+profiler = Profiler()
+
+if os.environ.get('SEGANY_PROFILE', 'off') in PROFILE_MODES[1:]:
+    profiler.start(os.environ['SEGANY_PROFILE'])
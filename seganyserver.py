@@ -0,0 +1,691 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Long-lived Segment Anything model server.
+
+Loading a SAM checkpoint takes many seconds and gigabytes of memory, so the
+plugin hands its work to this daemon instead of building a new
+SegmentAnythingProcessor on every invocation. The server keeps processors
+loaded (one per model type / checkpoint / options) in a ModelPool, so
+switching between e.g. vit_b previews and vit_h runs does not reload
+either, releasing the least recently used ones when the models exceed a
+memory budget. It is started on demand by SegmentAnythingClient and exits
+by itself after a configurable idle time.
+
+Transport is multiprocessing.connection over a Unix socket (localhost TCP
+where Unix sockets are not available), authenticated with a per-user key.
+A request sent with a task_id streams ('progress', ...) messages before
+its reply and can be stopped from another connection with 'cancel'.
+stream_segmentation also sends each mask as an ('item', ...) message as
+soon as it is ready, before the final reply.
+
+Each request uses its own connection, so interactive refinement sessions
+are not tied to one; a session unused for the session timeout is ended, so
+one left open by a client that went away does not keep its model pinned.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import argparse
+import functools
+import getpass
+import inspect
+import json
+import logging
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from seganyformat import pack_array, unpack_array
+from seganyprofile import profiler
+from seganytask import SegmentationTask, SegmentationCancelled
+
+DEFAULT_IDLE_TIMEOUT = 900  # seconds
+DEFAULT_SESSION_TIMEOUT = 600  # seconds a refinement session may go unused
+DEFAULT_START_TIMEOUT = 60  # seconds
+DEFAULT_TCP_PORT = 47621
+DEFAULT_MODEL_BUDGET = 8 * 1024 ** 3  # bytes; vit_h, vit_l and vit_b together take ~4 GiB
+
+
+class SegmentAnythingServerError(Exception):
+    pass
+
+
+def check_private(path, kind):
+    # Refuse a path another user could have planted or can read, e.g. a
+    # /tmp/segany-<user> directory created before we ran
+    if not hasattr(os, 'getuid'):
+        return
+    info = os.lstat(path)
+    is_kind = stat.S_ISDIR if kind == 'directory' else stat.S_ISREG
+    if not is_kind(info.st_mode):
+        raise SegmentAnythingServerError(f"{path} is not a {kind}")
+    if info.st_uid != os.getuid():
+        raise SegmentAnythingServerError(f"{path} is not owned by the current user")
+    if info.st_mode & 0o077:
+        raise SegmentAnythingServerError(f"{path} is accessible by other users (mode {stat.S_IMODE(info.st_mode):o})")
+
+
+def runtime_dir():
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    path = os.path.join(base, f'segany-{getpass.getuser()}')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    check_private(path, 'directory')
+    return path
+
+
+def default_address():
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(runtime_dir(), 'server.sock')
+    return ('127.0.0.1', DEFAULT_TCP_PORT)
+
+
+def format_address(address):
+    if isinstance(address, tuple):
+        return f'{address[0]}:{address[1]}'
+    return address
+
+
+def parse_address(text):
+    host, sep, port = text.rpartition(':')
+    if sep and host and port.isdigit():
+        return (host, int(port))
+    return text
+
+
+def get_authkey():
+    # Shared secret for client and server, readable only by the current user
+    keyfile = os.path.join(runtime_dir(), 'server.key')
+    try:
+        fd = os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        check_private(keyfile, 'file')
+        with open(keyfile, 'rb') as f:
+            return f.read()
+    key = os.urandom(32)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+
+class ModelPool:
+    '''
+    LRU of loaded SegmentAnythingProcessors (any key, e.g. model type,
+    checkpoint and options) bounded by max_bytes of model memory as reported
+    by processor.model_bytes(); 0 means no limit. Least recently used
+    processors are released to make room, before a load using the estimated
+    size and again once the real size is known. A processor with open
+    refinement sessions is never evicted, and neither is the one just loaded,
+    but their memory (session embeddings included) still counts against
+    max_bytes; update() re-measures and evicts once sessions start or end.
+    '''
+    def __init__(self, max_bytes=DEFAULT_MODEL_BUDGET):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> [processor, bytes, last used time]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, load, estimate=0):
+        # The processor for key, calling load() to create it when it is not pooled
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                entry[1] = entry[0].model_bytes()
+                entry[2] = time.time()
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        self.evict(estimate)
+        processor = load()
+        with self.lock:
+            self.entries[key] = [processor, processor.model_bytes(), time.time()]
+        self.evict(keep=key)
+        return processor
+
+    def update(self):
+        # Re-measure every pooled processor, then evict down to max_bytes
+        with self.lock:
+            for entry in self.entries.values():
+                entry[1] = entry[0].model_bytes()
+        return self.evict()
+
+    def nbytes(self):
+        with self.lock:
+            return sum(entry[1] for entry in self.entries.values())
+
+    def evict(self, extra=0, keep=None):
+        # Release least recently used processors until extra more bytes fit
+        if self.max_bytes <= 0:
+            return 0
+        evicted = []
+        with self.lock:
+            total = sum(entry[1] for entry in self.entries.values())
+            for key in list(self.entries):
+                if total + extra <= self.max_bytes:
+                    break
+                processor, size, _ = self.entries[key]
+                if key == keep or processor.sessions:
+                    continue
+                del self.entries[key]
+                total -= size
+                evicted.append((key, processor, size))
+            self.evictions += len(evicted)
+        for key, processor, size in evicted:
+            logging.info(f"Evicting model {key} ({size / 2**20:.0f} MiB)")
+            processor.release()
+        return len(evicted)
+
+    def usage(self):
+        # [(key, bytes, last used time, open sessions)], least recently used first
+        with self.lock:
+            return [(key, size, last_used, len(processor.sessions))
+                    for key, (processor, size, last_used) in self.entries.items()]
+
+
+def pack_results(results):
+    # Bit pack the masks so they cross the socket at 1/8th of their bool size
+    with profiler.span('serialization'):
+        return [dict(result, segmentation=pack_array(result['segmentation'])) for result in results]
+
+
+def unpack_results(results):
+    return [dict(result, segmentation=unpack_array(result['segmentation'])) for result in results]
+
+
+class SegmentAnythingServer:
+    def __init__(self, address, authkey, idle_timeout=DEFAULT_IDLE_TIMEOUT, embedding_cache_dir=None,
+                 model_budget=DEFAULT_MODEL_BUDGET, session_timeout=DEFAULT_SESSION_TIMEOUT):
+        self.address = address
+        self.authkey = authkey
+        self.idle_timeout = idle_timeout
+        self.session_timeout = session_timeout
+        self.embedding_cache_dir = embedding_cache_dir
+        self.processors = ModelPool(model_budget)
+        self.sessions = {}  # refinement session id -> [processor owning it, last used time]
+        self.tasks = {}  # task id -> SegmentationTask of a running request
+        self.model_lock = threading.Lock()  # serializes model loading and inference
+        self.state_lock = threading.Lock()
+        self.active_requests = 0
+        self.last_active = time.monotonic()
+        self.started = time.time()
+        self.running = False
+
+    def get_processor(self, model_type, checkpoint_path, processor_options=None):
+        # One processor per model and set of SegmentAnythingProcessor keyword
+        # options (cpu_options, backend, onnx_dir): an int8 model is a separate copy
+        processor_options = processor_options or {}
+        key = (model_type, checkpoint_path, json.dumps(processor_options, sort_keys=True))
+
+        def load():
+            from seganybridge import SegmentAnythingProcessor
+            logging.info(f"Loading {model_type} from {checkpoint_path} {processor_options}")
+            return SegmentAnythingProcessor(model_type, checkpoint_path,
+                                            embedding_cache_dir=self.embedding_cache_dir,
+                                            **processor_options)
+
+        # fp32 weights take about as much memory as the checkpoint file
+        estimate = os.path.getsize(checkpoint_path) if os.path.exists(checkpoint_path) else 0
+        return self.processors.get(key, load, estimate)
+
+    def handle_ping(self):
+        return {
+            'pid': os.getpid(),
+            'uptime': time.time() - self.started,
+            'idle_timeout': self.idle_timeout,
+            'models': [{'model_type': model_type, 'checkpoint_path': checkpoint_path,
+                        'options': json.loads(options), 'bytes': size, 'last_used': last_used,
+                        'sessions': sessions}
+                       for (model_type, checkpoint_path, options), size, last_used, sessions
+                       in self.processors.usage()],
+            'model_bytes': self.processors.nbytes(),
+            'model_budget': self.processors.max_bytes,
+            'model_hits': self.processors.hits,
+            'model_misses': self.processors.misses,
+            'model_evictions': self.processors.evictions,
+        }
+
+    def handle_shutdown(self):
+        self.running = False
+        return True
+
+    def handle_cancel(self, target):
+        # target is the task_id of the request to cancel
+        with self.state_lock:
+            task = self.tasks.get(target)
+        if task is None:
+            return False
+        logging.info(f"Cancelling request {target}")
+        task.cancel()
+        return True
+
+    def handle_run_segmentation(self, model_type, checkpoint_path, profile='off', task=None,
+                                processor_options=None, **kwargs):
+        # Returns {'results': bit packed mask records, 'profile': span report or None}
+        with self.model_lock:
+            if task is not None:
+                task.check()  # cancelled while waiting for the model
+            if profile != 'off':
+                profiler.start(profile)
+            try:
+                processor = self.get_processor(model_type, checkpoint_path, processor_options)
+                results = pack_results(processor.run_segmentation(task=task, **kwargs))
+            finally:
+                report = profiler.stop() if profile != 'off' else None
+                self.processors.update()  # e.g. onnx-full loads its torch model on the first Auto run
+            return {'results': results, 'profile': report}
+
+    def handle_stream_segmentation(self, model_type, checkpoint_path, profile='off', task=None,
+                                   processor_options=None, **kwargs):
+        # Generator: yields bit packed mask records as they are produced and
+        # returns {'count': masks sent, 'profile': span report or None}. The
+        # model stays locked until the client has received the last mask.
+        with self.model_lock:
+            if task is not None:
+                task.check()
+            if profile != 'off':
+                profiler.start(profile)
+            count = 0
+            try:
+                processor = self.get_processor(model_type, checkpoint_path, processor_options)
+                for record in processor.iter_segmentation(task=task, **kwargs):
+                    yield pack_results([record])[0]
+                    count += 1
+            finally:
+                report = profiler.stop() if profile != 'off' else None
+                self.processors.update()
+            return {'count': count, 'profile': report}
+
+    def handle_start_session(self, model_type, checkpoint_path, processor_options=None, **kwargs):
+        with self.model_lock:
+            processor = self.get_processor(model_type, checkpoint_path, processor_options)
+            session_id = processor.start_session(**kwargs)
+            self.sessions[session_id] = [processor, time.monotonic()]
+            self.processors.update()  # the session's embedding now counts against the budget
+            return session_id
+
+    def get_session(self, session_id):
+        # The processor owning session_id; using a session keeps it from expiring
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            raise KeyError(f"Refinement session {session_id} has ended or expired")
+        entry[1] = time.monotonic()
+        return entry[0]
+
+    def handle_update_session(self, session_id, points, labels):
+        with self.model_lock:
+            processor = self.get_session(session_id)
+            return pack_results([processor.update_session(session_id, points, labels)])[0]
+
+    def handle_undo_session(self, session_id):
+        with self.model_lock:
+            record = self.get_session(session_id).undo_session(session_id)
+            return None if record is None else pack_results([record])[0]
+
+    def handle_end_session(self, session_id):
+        with self.model_lock:
+            entry = self.sessions.pop(session_id, None)
+            if entry is None:
+                return False
+            entry[0].end_session(session_id)
+            self.processors.update()  # the processor may be evictable again
+            return True
+
+    def expire_sessions(self):
+        # End the sessions unused for session_timeout, e.g. of a client that went away
+        with self.model_lock:
+            now = time.monotonic()
+            expired = [session_id for session_id, (_, last_used) in self.sessions.items()
+                       if now - last_used > self.session_timeout]
+            for session_id in expired:
+                logging.info(f"Refinement session {session_id} unused for {self.session_timeout}s, ending it")
+                self.sessions.pop(session_id)[0].end_session(session_id)
+            if expired:
+                self.processors.update()
+            return len(expired)
+
+    def dispatch(self, request, conn):
+        cmd, kwargs = request
+        handler = getattr(self, 'handle_' + cmd, None)
+        if handler is None:
+            raise ValueError(f"Unknown server command: {cmd}")
+        task_id = kwargs.pop('task_id', None)
+        if task_id is None:
+            return self.stream(handler(**kwargs), conn)
+        # Progress goes back on the request's own connection; if the client
+        # has gone away the failed send aborts the work as well
+        task = SegmentationTask(lambda stage, fraction, info: conn.send(('progress', (stage, fraction, info))))
+        with self.state_lock:
+            self.tasks[task_id] = task
+        try:
+            return self.stream(handler(task=task, **kwargs), conn)
+        finally:
+            with self.state_lock:
+                self.tasks.pop(task_id, None)
+
+    def stream(self, result, conn):
+        # A generator handler's items are sent as ('item', ...) messages; its return value is the reply
+        if not inspect.isgenerator(result):
+            return result
+        try:
+            while True:
+                try:
+                    item = next(result)
+                except StopIteration as stop:
+                    return stop.value
+                conn.send(('item', item))
+        finally:
+            result.close()  # releases the model lock when the client went away
+
+    def serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                with self.state_lock:
+                    self.active_requests += 1
+                try:
+                    reply = ('ok', self.dispatch(request, conn))
+                except SegmentationCancelled as e:
+                    reply = ('cancelled', str(e))
+                except Exception as e:
+                    logging.error(traceback.format_exc())
+                    reply = ('error', f"{type(e).__name__}: {e}")
+                finally:
+                    with self.state_lock:
+                        self.active_requests -= 1
+                        self.last_active = time.monotonic()
+                try:
+                    conn.send(reply)
+                except OSError:
+                    break
+                if not self.running:
+                    self.wake()
+                    break
+
+    def wake(self):
+        # Unblock the accept() in serve_forever so it can notice running == False
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+
+    def watch_idle(self):
+        while self.running:
+            time.sleep(min(self.idle_timeout, 5))
+            with self.state_lock:
+                idle = self.active_requests == 0 and \
+                    time.monotonic() - self.last_active > self.idle_timeout
+            if idle:
+                logging.info(f"Idle for {self.idle_timeout}s, shutting down")
+                self.running = False
+                self.wake()
+
+    def watch_sessions(self):
+        while self.running:
+            time.sleep(min(self.session_timeout, 30))
+            self.expire_sessions()
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        listener = Listener(self.address, authkey=self.authkey)
+        self.running = True
+        logging.info(f"SAM server {os.getpid()} listening on {format_address(self.address)}")
+        if self.idle_timeout > 0:
+            threading.Thread(target=self.watch_idle, daemon=True).start()
+        if self.session_timeout > 0:
+            threading.Thread(target=self.watch_sessions, daemon=True).start()
+        try:
+            while self.running:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, AuthenticationError) as e:
+                    logging.warning(f"Rejected connection: {e}")
+                    continue
+                if not self.running:
+                    conn.close()
+                    break
+                threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+        logging.info("SAM server stopped")
+
+
+class SegmentAnythingClient:
+    '''
+    Drop-in stand-in for SegmentAnythingProcessor that forwards calls to the
+    model server, starting it with python_path if it is not running yet.
+    '''
+    def __init__(self, model_type, checkpoint_path, python_path=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, address=None, embedding_cache_dir=None,
+                 processor_options=None, model_budget=DEFAULT_MODEL_BUDGET):
+        self.model_type = model_type
+        self.checkpoint_path = os.path.abspath(checkpoint_path) if checkpoint_path else checkpoint_path
+        self.python_path = python_path or sys.executable
+        self.idle_timeout = idle_timeout
+        self.embedding_cache_dir = embedding_cache_dir
+        self.processor_options = processor_options  # extra SegmentAnythingProcessor keyword arguments
+        self.model_budget = model_budget  # only used when this client starts the server
+        self.address = address or default_address()
+        self.authkey = get_authkey()
+
+    def call(self, cmd, task=None, **kwargs):
+        # With a SegmentationTask the server's progress is forwarded to it and
+        # task.cancel() cancels the request on the server
+        stream = self.call_stream(cmd, task, **kwargs)
+        while True:
+            try:
+                next(stream)
+            except StopIteration as stop:
+                return stop.value
+
+    def call_stream(self, cmd, task=None, **kwargs):
+        # Generator version of call: yields the items a streaming command sends
+        # and returns its reply. Closing it early closes the connection, which
+        # stops the server at its next send.
+        with Client(self.address, authkey=self.authkey) as conn:
+            if task is not None:
+                task_id = uuid.uuid4().hex
+                kwargs['task_id'] = task_id
+                cancel = functools.partial(self.cancel, task_id)
+                task.cancel_callbacks.append(cancel)
+            try:
+                conn.send((cmd, kwargs))
+                while True:
+                    status, result = conn.recv()
+                    if status == 'progress':
+                        stage, fraction, info = result
+                        task.report(stage, fraction, **info)
+                    elif status == 'item':
+                        yield result
+                    else:
+                        break
+            finally:
+                if task is not None:
+                    task.cancel_callbacks.remove(cancel)
+        if status == 'cancelled':
+            raise SegmentationCancelled(result)
+        if status != 'ok':
+            raise SegmentAnythingServerError(result)
+        return result
+
+    def cancel(self, task_id):
+        try:
+            return self.call('cancel', target=task_id)
+        except (OSError, EOFError, AuthenticationError):
+            return False
+
+    def ping(self):
+        try:
+            return self.call('ping')
+        except (OSError, EOFError, AuthenticationError):
+            return None
+
+    def start_server(self):
+        cmd = [self.python_path, os.path.abspath(__file__),
+               '--address', format_address(self.address),
+               '--idle-timeout', str(self.idle_timeout),
+               '--model-budget', str(self.model_budget / 1024 ** 3)]
+        if self.embedding_cache_dir:
+            cmd += ['--embedding-cache-dir', self.embedding_cache_dir]
+        logging.info(f"Starting SAM server: {' '.join(cmd)}")
+        logfile = open(os.path.join(runtime_dir(), 'server.log'), 'a')
+        kwargs = {'start_new_session': True} if os.name == 'posix' else \
+            {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+        try:
+            return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=logfile,
+                                    stderr=subprocess.STDOUT, close_fds=True, **kwargs)
+        finally:
+            logfile.close()
+
+    def ensure_running(self, timeout=DEFAULT_START_TIMEOUT):
+        info = self.ping()
+        if info is not None:
+            return info
+        process = self.start_server()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            info = self.ping()
+            if info is not None:
+                return info
+            if process.poll() is not None:
+                raise SegmentAnythingServerError(
+                    f"SAM server exited with code {process.returncode}, "
+                    f"see {os.path.join(runtime_dir(), 'server.log')}")
+            time.sleep(0.2)
+        raise SegmentAnythingServerError(f"SAM server did not start within {timeout}s")
+
+    def shutdown(self):
+        try:
+            return self.call('shutdown')
+        except (OSError, EOFError, AuthenticationError):
+            return False
+
+    def run_segmentation(self, ip_file, seg_type, mask_type, save_file_no_ext=None, format_binary=True,
+                         task=None, **kwargs):
+        # kwargs are passed through to SegmentAnythingProcessor.run_segmentation
+        self.ensure_running()
+        reply = self.call(
+            'run_segmentation', task=task, model_type=self.model_type,
+            checkpoint_path=self.checkpoint_path, processor_options=self.processor_options,
+            ip_file=ip_file, seg_type=seg_type, mask_type=mask_type,
+            save_file_no_ext=save_file_no_ext, format_binary=format_binary,
+            profile=profiler.mode if profiler.enabled else 'off', **kwargs)
+        profiler.merge(reply['profile'])
+        with profiler.span('deserialization'):
+            return unpack_results(reply['results'])
+
+    def iter_segmentation(self, ip_file, seg_type, mask_type, save_file_no_ext=None, format_binary=True,
+                          task=None, **kwargs):
+        # Streaming run_segmentation: masks are unpacked and yielded as the server sends them
+        self.ensure_running()
+        stream = self.call_stream(
+            'stream_segmentation', task=task, model_type=self.model_type,
+            checkpoint_path=self.checkpoint_path, processor_options=self.processor_options,
+            ip_file=ip_file, seg_type=seg_type, mask_type=mask_type,
+            save_file_no_ext=save_file_no_ext, format_binary=format_binary,
+            profile=profiler.mode if profiler.enabled else 'off', **kwargs)
+        while True:
+            try:
+                record = next(stream)
+            except StopIteration as stop:
+                profiler.merge(stop.value['profile'])
+                return
+            with profiler.span('deserialization'):
+                record = unpack_results([record])[0]
+            yield record
+
+    def start_session(self, ip_file, box_cos=None):
+        self.ensure_running()
+        return self.call('start_session', model_type=self.model_type,
+                         checkpoint_path=self.checkpoint_path, processor_options=self.processor_options,
+                         ip_file=ip_file, box_cos=box_cos)
+
+    def update_session(self, session_id, points, labels):
+        return unpack_results([self.call('update_session', session_id=session_id,
+                                         points=points, labels=labels)])[0]
+
+    def undo_session(self, session_id):
+        record = self.call('undo_session', session_id=session_id)
+        return None if record is None else unpack_results([record])[0]
+
+    def end_session(self, session_id):
+        try:
+            return self.call('end_session', session_id=session_id)
+        except (OSError, EOFError, AuthenticationError):
+            return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Segment Anything model server')
+    parser.add_argument('--address', default=None,
+                        help='Unix socket path or host:port (default: per-user socket)')
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help='Seconds without requests before exiting, 0 to never exit')
+    parser.add_argument('--session-timeout', type=float, default=DEFAULT_SESSION_TIMEOUT,
+                        help='Seconds a refinement session may go unused before it is ended, 0 to keep it')
+    parser.add_argument('--embedding-cache-dir', default=None,
+                        help='Directory to spill image embeddings evicted from memory')
+    parser.add_argument('--model-budget', type=float, default=DEFAULT_MODEL_BUDGET / 1024 ** 3,
+                        help='GiB of loaded models to keep before evicting the least recently used, 0 for no limit')
+    parser.add_argument('--ping', action='store_true', help='Print server status and exit')
+    parser.add_argument('--shutdown', action='store_true', help='Stop a running server')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    address = parse_address(args.address) if args.address else default_address()
+    client = SegmentAnythingClient(None, None, address=address)
+    if args.ping or args.shutdown:
+        result = client.shutdown() if args.shutdown else client.ping()
+        print(result)
+        return 0 if result else 1
+
+    if client.ping() is not None:
+        logging.info(f"SAM server already running on {format_address(address)}")
+        return 0
+
+    server = SegmentAnythingServer(address, client.authkey, args.idle_timeout,
+                                   args.embedding_cache_dir, int(args.model_budget * 1024 ** 3),
+                                   args.session_timeout)
+    server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
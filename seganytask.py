@@ -0,0 +1,69 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Progress reporting and cancellation for a running segmentation.
+
+A SegmentationTask is handed to SegmentAnythingProcessor.run_segmentation.
+The processor calls step() at each stage (and per decoder batch in Auto
+mode), which forwards the progress to the callback and raises
+SegmentationCancelled once cancel() has been called from another thread.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import threading
+
+
+class SegmentationCancelled(Exception):
+    pass
+
+
+class SegmentationTask:
+    def __init__(self, callback=None):
+        # callback(stage, fraction, info): fraction is 0..1 or None when unknown
+        self.callback = callback
+        self.cancelled = threading.Event()
+        self.cancel_callbacks = []
+
+    def cancel(self):
+        if not self.cancelled.is_set():
+            self.cancelled.set()
+            for callback in self.cancel_callbacks:
+                callback()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise SegmentationCancelled("Segmentation cancelled")
+
+    def report(self, stage, fraction=None, **info):
+        if self.callback is not None:
+            self.callback(stage, fraction, info)
+
+    def step(self, stage, fraction=None, **info):
+        self.report(stage, fraction, **info)
+        self.check()
+
+
+def describe_progress(stage, info):
+    # One line status text for a progress report
+    text = stage.replace('_', ' ').capitalize()
+    if 'masks' in info:
+        text += f": {info['masks']} masks so far"
+    if 'tile' in info:
+        text += f" (tile {info['tile']} of {info['tiles']})"
+    return text
@@ -0,0 +1,214 @@
+#!/home/chuck/venv/bin/python3
+# -*- coding: utf-8 -*-
+#
+'''
+Converted checkpoint cache: SAM weights memory-mapped instead of unpickled.
+
+A .pth checkpoint is converted once into a safetensors file (by default in
+a 'converted' directory next to the checkpoint). Later loads build the
+model on the meta device, so no random initialization runs, and assign it
+tensors that view a copy-on-write np.memmap of that file. Nothing is read
+until a weight is used, and processes on one host share the pages through
+the page cache. The file also holds SAM's non-persistent buffers
+(pixel_mean, pixel_std), which a state dict leaves out. The source size,
+modification time and model type are recorded in the header, so a replaced
+checkpoint, or one loaded as another model type, is converted again.
+
+The file layout is the safetensors format (8 byte header length, JSON
+header, then the tensors back to back), written and read here without the
+safetensors package. Tensors are sorted by item size so every one is
+aligned for its dtype.
+
+Author: Chuck Sites
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+import json
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+from seganyprofile import profiler
+
+HEADER_ALIGN = 8
+# safetensors dtype name: (numpy dtype the bytes are viewed as, torch dtype name)
+# bfloat16 has no numpy dtype, so its bytes are viewed as int16
+DTYPES = {
+    'F64': (np.float64, 'float64'),
+    'F32': (np.float32, 'float32'),
+    'F16': (np.float16, 'float16'),
+    'BF16': (np.int16, 'bfloat16'),
+    'I64': (np.int64, 'int64'),
+    'I32': (np.int32, 'int32'),
+    'I16': (np.int16, 'int16'),
+    'I8': (np.int8, 'int8'),
+    'U8': (np.uint8, 'uint8'),
+    'BOOL': (np.bool_, 'bool'),
+}
+TORCH_DTYPES = {torch_name: name for name, (_, torch_name) in DTYPES.items()}
+
+
+def weights_path(checkpoint_path, weights_dir=None):
+    stem = os.path.splitext(os.path.basename(str(checkpoint_path)))[0]
+    weights_dir = weights_dir or os.path.join(os.path.dirname(os.path.abspath(str(checkpoint_path))),
+                                              'converted')
+    return os.path.join(weights_dir, stem + '.safetensors')
+
+
+def source_metadata(checkpoint_path):
+    stat = os.stat(checkpoint_path)
+    return {'source': os.path.basename(str(checkpoint_path)), 'source_size': str(stat.st_size),
+            'source_mtime_ns': str(stat.st_mtime_ns)}
+
+
+# safetensors files
+
+def write_safetensors(filepath, arrays, metadata=None):
+    # arrays: {name: (dtype name, C-contiguous ndarray)}; written to a temp file and renamed
+    names = sorted(arrays, key=lambda name: -arrays[name][1].dtype.itemsize)
+    header = {'__metadata__': dict(metadata or {})}
+    offset = 0
+    for name in names:
+        dtype, arr = arrays[name]
+        header[name] = {'dtype': dtype, 'shape': list(arr.shape), 'data_offsets': [offset, offset + arr.nbytes]}
+        offset += arr.nbytes
+    data = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    data += b' ' * (-(len(data) + 8) % HEADER_ALIGN)
+
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+    tmppath = filepath + f'.{os.getpid()}.tmp'
+    try:
+        with open(tmppath, 'wb') as f:
+            f.write(struct.pack('<Q', len(data)))
+            f.write(data)
+            for name in names:
+                f.write(np.ascontiguousarray(arrays[name][1]).data)
+        os.replace(tmppath, filepath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def read_header(filepath):
+    with open(filepath, 'rb') as f:
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size))
+    return header, 8 + size
+
+
+def read_safetensors(filepath):
+    # {name: (dtype name, ndarray view of a copy-on-write memmap)}, metadata
+    header, base = read_header(filepath)
+    metadata = header.pop('__metadata__', {})
+    raw = np.memmap(filepath, dtype=np.uint8, mode='c')
+    arrays = {}
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        np_dtype = DTYPES[info['dtype']][0]
+        arrays[name] = (info['dtype'], np.asarray(raw[base + start:base + end]).view(np_dtype).reshape(info['shape']))
+    return arrays, metadata
+
+
+def is_current(filepath, checkpoint_path, model_type):
+    # The converted file exists and was made from this version of the checkpoint as model_type
+    if not os.path.exists(filepath):
+        return False
+    try:
+        metadata = read_header(filepath)[0].get('__metadata__', {})
+    except (OSError, ValueError, struct.error):
+        return False
+    current = dict(source_metadata(checkpoint_path), model_type=model_type)
+    return all(metadata.get(key) == value for key, value in current.items() if key != 'source')
+
+
+# torch side
+
+def model_tensors(sam):
+    # Parameters and all buffers, including the non-persistent ones a state dict skips
+    tensors = dict(sam.named_parameters())
+    tensors.update(sam.named_buffers())
+    return tensors
+
+
+def convert_checkpoint(model_type, checkpoint_path, filepath):
+    import torch
+    from segment_anything import sam_model_registry
+    logging.info(f"Converting {checkpoint_path} to {filepath}")
+    with profiler.span('weights_convert'):
+        sam = sam_model_registry[model_type](checkpoint=checkpoint_path)
+        arrays = {}
+        for name, tensor in model_tensors(sam).items():
+            tensor = tensor.detach().cpu().contiguous()
+            dtype = TORCH_DTYPES[str(tensor.dtype).replace('torch.', '')]
+            if dtype == 'BF16':
+                arrays[name] = (dtype, tensor.view(torch.int16).numpy())
+            else:
+                arrays[name] = (dtype, tensor.numpy())
+        metadata = dict(source_metadata(checkpoint_path), model_type=model_type)
+        write_safetensors(filepath, arrays, metadata)
+    return sam
+
+
+def assign_tensors(sam, tensors):
+    # Replace the meta parameters and buffers of sam with the loaded tensors
+    import torch
+    for name, tensor in tensors.items():
+        module_name, _, leaf = name.rpartition('.')
+        module = sam.get_submodule(module_name)
+        if leaf in module._parameters:
+            module._parameters[leaf] = torch.nn.Parameter(tensor, requires_grad=False)
+        elif leaf in module._buffers:
+            module._buffers[leaf] = tensor
+        else:
+            raise KeyError(f"Converted weights have an unknown tensor: {name}")
+    missing = [name for name, tensor in model_tensors(sam).items() if tensor.is_meta]
+    if missing:
+        raise KeyError(f"Converted weights are missing {len(missing)} tensors, e.g. {missing[0]}")
+
+
+def load_converted(model_type, filepath):
+    import torch
+    from segment_anything import sam_model_registry
+    with profiler.span('weights_mmap'):
+        arrays, _ = read_safetensors(filepath)
+        tensors = {}
+        for name, (dtype, arr) in arrays.items():
+            tensor = torch.from_numpy(arr)
+            if dtype == 'BF16':
+                tensor = tensor.view(torch.bfloat16)
+            tensors[name] = tensor
+        # Built on the meta device: no memory allocated and no initialization run
+        with torch.device('meta'):
+            sam = sam_model_registry[model_type]()
+        assign_tensors(sam, tensors)
+    return sam
+
+
+def load_sam(model_type, checkpoint_path, weights_dir=None):
+    # SAM from the converted cache, converting the checkpoint on first use
+    filepath = weights_path(checkpoint_path, weights_dir)
+    start = time.perf_counter()
+    if is_current(filepath, checkpoint_path, model_type):
+        sam = load_converted(model_type, filepath)
+        logging.info(f"Mapped {filepath} in {time.perf_counter() - start:.2f} s (warm load)")
+        return sam
+    sam = convert_checkpoint(model_type, checkpoint_path, filepath)
+    logging.info(f"Loaded and converted {checkpoint_path} in {time.perf_counter() - start:.2f} s (cold load)")
+    return sam